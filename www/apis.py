@@ -1,4 +1,5 @@
 import json
+import base64
 import logging
 import inspect
 import functools
@@ -28,6 +29,43 @@ class Page(object):
     __repr__ = __str__
 
 
+# 键集分页的游标对客户端是不透明的：把(created_at, id)这样的排序键序列化成json再做urlsafe base64
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor: %s' % token)
+    # 游标是(created_at, id)：第一个是数字，第二个是字符串或整数主键；bool在json里也能解析出来，要排除
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor: %s' % token)
+    key, pk = values
+    if isinstance(key, bool) or not isinstance(key, (int, float)):
+        raise ValueError('Invalid cursor: %s' % token)
+    if isinstance(pk, bool) or not isinstance(pk, (str, int)):
+        raise ValueError('Invalid cursor: %s' % token)
+    return tuple(values)
+
+
+# 游标分页用的Page：不需要总条数和offset，只告诉客户端下一页/上一页的游标
+# first和last是当前页第一行、最后一行的排序键，比如(blog.created_at, blog.id)
+class CursorPage(object):
+    def __init__(self, first=None, last=None, page_size=10, has_next=False, has_previous=False):
+        self.page_size = page_size
+        self.has_next = has_next and last is not None
+        self.has_previous = has_previous and first is not None
+        self.next_cursor = encode_cursor(last) if self.has_next else None
+        self.prev_cursor = encode_cursor(first) if self.has_previous else None
+
+    def __str__(self):
+        return 'page_size: %s, has_next: %s, has_previous: %s, next_cursor: %s, prev_cursor: %s' % (
+            self.page_size, self.has_next, self.has_previous, self.next_cursor, self.prev_cursor)
+    __repr__ = __str__
+
+
 class APIError(Exception):
     def __init__(self, error, data='', message=''):
         super(APIError, self).__init__(message)
@@ -7,9 +7,12 @@ import time
 from datetime import datetime
 from jinja2 import Environment, FileSystemLoader
 import www.orm
+import www.ids
+import www.schema
 from www.coroweb import add_routes, add_static
 from www.config import configs
 from www.handlers import cookie2user, COOKIE_NAME
+from www.models import User, Blog, Comment
 
 
 def init_jinja2(app, **kw):
@@ -58,6 +61,7 @@ async def auth_factory(app, handler):
             if user:
                 logging.info('set current user: %s' % user.email)
                 request.__user__ = user
+                www.orm.set_consistency_key(user.id)  # 读写分离时，保证用户能读到自己刚写的数据
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
         return await handler(request)
@@ -87,10 +91,24 @@ async def data_factory(app, handler):
 # 注：在response_factory中应用了jinja2来渲染模板文件
 
 
+# json.dumps遇到不认识的对象时的转换：orm.Row这样的紧凑行对象用to_dict()，其他对象(比如Page)用__dict__
+def json_default(o):
+    if hasattr(o, 'to_dict'):
+        return o.to_dict()
+    return o.__dict__
+
+
 async def response_factory(app, handler):
     async def response(request):
         logging.info('Response handler....')
-        r = await handler(request)
+        try:
+            r = await handler(request)
+        except www.orm.PoolTimeoutError as e:  # 数据库连接不够用，稍后重试
+            logging.warning('%s %s: %s' % (request.method, request.path, e))
+            return web.Response(status=503, text='Service Unavailable', headers={'Retry-After': '1'})
+        except www.orm.QueryTimeoutError as e:
+            logging.warning('%s %s: %s' % (request.method, request.path, e))
+            return web.Response(status=504, text='Gateway Timeout')
         if isinstance(r, web.StreamResponse):
             return r
         if isinstance(r, bytes):
@@ -106,7 +124,7 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -141,7 +159,15 @@ def datetime_filter(t):
 
 
 async def init(loop):
+    www.ids.set_id_generator(configs.ids.generator)  # 新记录的主键用哪种ID
     await www.orm.create_pool(loop=loop, **configs.db)  # 首先先连接数据库
+    if configs.db.driver == 'sqlite':
+        await www.schema.create_all()  # 嵌入式数据库在启动时自动建表
+    www.orm.start_counter_reconciler([User, Blog, Comment])  # 定期用真实的count校正各表的行数计数器
+    if configs.write_behind.enabled:  # 重放上次没写完的评论日志，之后新评论走写后缓冲
+        opts = dict(configs.write_behind)
+        del opts['enabled']
+        await www.orm.start_write_behind(Comment, **opts)
     # 连接数据库之后会根据aiohttp来构造一个app类
     # 把app类与线程绑定并为app类添加middlewares
     # middlewares(中间件)设置3个中间处理函数(都是装饰器)
@@ -152,7 +178,7 @@ async def init(loop):
     app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
     # 注册模板
     init_jinja2(app, filters=dict(datetime=datetime_filter))
-    add_routes(app, 'handlers')  # 注册url处理函数 这一步其实做了很多工作，
+    add_routes(app, 'handlers', timeout=configs.request_timeout)  # 注册url处理函数 这一步其实做了很多工作，
     add_static(app)  # 添加静态文件
     runner = web.AppRunner(app)
     await runner.setup()
@@ -2,14 +2,44 @@
 
 configs = {
     'debug': True,
+    'request_timeout': 10,  # 每个请求里数据库查询的默认总时限(秒)，单个路由可以在@get/@post里用timeout覆盖
     'db': {
+        'driver': 'mysql',  # 'mysql'或'sqlite'
+        'path': 'awesome.db',  # driver='sqlite'时的数据库文件，':memory:'表示内存数据库
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'replicas': [],
+        'shards': None,  # 比如{'comments': [{'host': ...}, {'host': ...}]}，按Comment.__shard_key__分到这几个库
+        'read_your_writes': 5,
+        'check_indexes': True,
+        'query_cache': {
+            'maxsize': 1000,  # 查询结果缓存最多多少条
+            'ttl': 30  # 秒，即使表没有被改过也最多缓存这么久(其他进程的写入靠这个同步)
+        },
+        'fanout_limit': 4,  # orm.gather一个请求最多同时占用的连接数
+        'warmup': 5,  # 启动时每个连接池预先建好的连接数
+        'checkout_timeout': 5,  # 借连接最多等多少秒，超时抛PoolTimeoutError
+        'ping_after': 30,  # 空闲超过多少秒的连接借出前先ping
+        'slow_query': {
+            'threshold': 0.2,  # 超过多少秒算慢查询
+            'sample_rate': 1.0,  # 慢查询写日志的比例
+            'explain': True  # 慢的select自动EXPLAIN一次
+        }
     },
     'session': {
         'secret': 'Awesome'
+    },
+    'write_behind': {
+        'enabled': False,  # 评论先写本地日志再批量入库，高峰时api_create_comment不用等INSERT
+        'journal': 'comments.journal',
+        'interval': 0.05,  # 秒，最多攒这么久就写一次数据库
+        'batch_size': 500,  # 攒够这么多行立刻写
+        'maxsize': 10000  # 队列里最多这么多行，满了新的评论要等
+    },
+    'ids': {
+        'generator': 'legacy'
     }
 }
\ No newline at end of file
@@ -6,27 +6,31 @@ import functools
 from urllib import parse
 from aiohttp import web
 from www.apis import APIError
+from www.orm import deadline
 
 
 # 创建带参数的装饰器
-def get(path):
+# timeout=秒数，这个URL处理函数里所有数据库查询的总时限，不写就用add_routes的默认值
+def get(path, timeout=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__timeout__ = timeout
         return wrapper
     return decorator
 
 
-def post(path):
+def post(path, timeout=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__timeout__ = timeout
         return wrapper
     return decorator
 
@@ -97,9 +101,10 @@ def has_request_arg(fn):
 
 class RequestHandler(object):
 
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, timeout=None):
         self._app = app
         self._func = fn
+        self._timeout = timeout
         self._has_request_arg = has_request_arg(fn)
         self._has_var_kw_arg = has_var_kw_arg(fn)
         self._has_named_kw_args = has_named_kw_args(fn)
@@ -154,8 +159,10 @@ class RequestHandler(object):
                     return web.HTTPBadRequest('Missing argument: %s' % name)
         logging.info('call with args: %s' % str(kw))
         try:
-            r = await self._func(**kw)
-            return r
+            if self._timeout is None:
+                return await self._func(**kw)
+            with deadline(self._timeout):  # 超时的查询会抛出orm.QueryTimeoutError，由response_factory转成504
+                return await self._func(**kw)
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
@@ -167,18 +174,20 @@ def add_static(app):
     # INFO:root:add static /static/ => /Users/gonghuidepro/PycharmProjects/awesome-python3-webapp/www/static
 
 
-def add_route(app, fn):
+def add_route(app, fn, timeout=None):
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
+    timeout = getattr(fn, '__timeout__', None) or timeout
     if path is None or method is None:
         raise ValueError('@get and @post is not defined in %s.' % str(fn))
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    app.router.add_route(method, path, RequestHandler(app, fn, timeout))
 
 
-def add_routes(app, module_name):
+# timeout是没有在@get/@post里指定timeout的URL处理函数的默认时限
+def add_routes(app, module_name, timeout=None):
     n = module_name.rfind('.')  # app.py文件里面调用了add_routes(),并传入参数app和 handlers,而handlers.rfind('.')显然返回-1
     if n == (-1):
         mod = __import__(module_name, globals(), locals())  # 这一步相当于动态导入handlers模块
@@ -203,7 +212,7 @@ def add_routes(app, module_name):
             method = getattr(fn, '__method__', None)
             path = getattr(fn, '__route__', None)
             if method and path:
-                add_route(app, fn)
+                add_route(app, fn, timeout)
 
 
 
@@ -0,0 +1,307 @@
+# 数据库驱动
+# orm里的SQL统一按MySQL的写法生成：%s占位符、反引号引用表名和列名、limit ?, ?。
+# 驱动负责创建连接池、按需要的行格式(dict/元组、普通/流式)提供游标，并把SQL翻译成自己的方言。
+# 每条不同的SQL只翻译一次，翻译结果缓存在驱动里，执行时只是一次字典查找。
+import os
+import asyncio
+import logging
+import shutil
+import sqlite3
+import tempfile
+import functools
+import collections
+import concurrent.futures
+
+
+class MySQLDriver(object):
+    name = 'mysql'
+    insert_ignore = 'insert ignore'
+    explain = 'explain '
+    window_functions = True  # 先假定支持(MySQL 8.0)，第一次执行报语法错误再退回，见Model.findPage
+
+    def __init__(self):
+        import aiomysql  # 只用SQLite时可以不装aiomysql
+        self._aiomysql = aiomysql
+        self.syntax_errors = (aiomysql.ProgrammingError,)
+        self._upserts = dict()
+
+    async def create_pool(self, loop, kw):
+        return await self._aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 20),
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        )
+
+    def sql(self, sql):
+        return sql
+
+    # 给select加上MAX_EXECUTION_TIME提示，超时由MySQL自己终止查询
+    def with_timeout(self, sql, timeout):
+        if timeout is None or not sql[:6].lower() == 'select':
+            return sql
+        return 'select /*+ MAX_EXECUTION_TIME(%d) */%s' % (max(int(timeout * 1000), 1), sql[6:])
+
+    # MAX_EXECUTION_TIME从语句发到服务器时开始算，通常比客户端的wait_for先到，
+    # 这时MySQL返回错误3024(ER_QUERY_TIMEOUT)，连接本身还是好的
+    def timed_out(self, e):
+        return isinstance(e, self._aiomysql.OperationalError) and bool(e.args) and e.args[0] == 3024
+
+    # 另开一个连接执行KILL QUERY，终止conn上正在执行的语句
+    async def kill(self, conn):
+        killer = await self._aiomysql.connect(host=conn.host, port=conn.port, user=conn.user,
+                                              password=conn._password, db=conn.db)
+        try:
+            async with killer.cursor() as cur:
+                await cur.execute('KILL QUERY %d' % conn.thread_id())
+        finally:
+            killer.close()
+
+    def cursor(self, conn, as_tuple=False, stream=False):
+        m = self._aiomysql
+        if stream:
+            return conn.cursor(m.SSCursor if as_tuple else m.SSDictCursor)
+        return conn.cursor(m.Cursor if as_tuple else m.DictCursor)
+
+    # 按key插入或覆盖一行
+    def upsert(self, table, columns, key):
+        sql = self._upserts.get((table, columns, key))
+        if sql is None:
+            sql = self._upserts[(table, columns, key)] = 'insert into `%s` (%s) values (%s) on duplicate key update %s' % (
+                table, ', '.join('`%s`' % c for c in columns), ', '.join(['%s'] * len(columns)),
+                ', '.join('`%s`=values(`%s`)' % (c, c) for c in columns if c != key))
+        return sql
+
+
+# SQLite驱动：用标准库的sqlite3，查询放到线程池里执行，不阻塞事件循环。
+# 数据库文件用WAL模式，读写可以并发；path=':memory:'时在临时目录里建一个库，连接池关闭时删掉。
+# (共享缓存的内存数据库用的是表级锁，并发时直接报database table is locked，busy_timeout也不管用)
+# SQLite本身支持limit ?, ?的写法，只需要翻译占位符和引号。
+class SQLiteDriver(object):
+    name = 'sqlite'
+    insert_ignore = 'insert or ignore'
+    explain = 'explain query plan '
+    # SQLite从3.25开始支持窗口函数，启动时就能确定，不靠报错判断：
+    # sqlite3.OperationalError也包括database is locked这类临时错误，不能当作不支持的信号
+    window_functions = sqlite3.sqlite_version_info >= (3, 25, 0)
+    syntax_errors = ()
+
+    def __init__(self):
+        self._translated = dict()
+        self._upserts = dict()
+
+    async def create_pool(self, loop, kw):
+        pool = SQLitePool(kw.get('path', 'awesome.db'), kw.get('maxsize', 10), kw.get('minsize', 1))
+        await pool.fill()
+        return pool
+
+    def sql(self, sql):
+        translated = self._translated.get(sql)
+        if translated is None:
+            translated = sql.replace('%s', '?').replace('`', '"')
+            if len(self._translated) < 4096:
+                self._translated[sql] = translated
+        return translated
+
+    def with_timeout(self, sql, timeout):
+        return sql
+
+    def timed_out(self, e):
+        return False
+
+    # sqlite3的interrupt()可以在别的线程调用，让正在执行的语句尽快失败返回
+    async def kill(self, conn):
+        conn.db.interrupt()
+
+    def cursor(self, conn, as_tuple=False, stream=False):
+        return conn.cursor(as_tuple)  # sqlite3的游标本来就是边读边取的，流式和普通游标是一样的
+
+    def upsert(self, table, columns, key):
+        sql = self._upserts.get((table, columns, key))
+        if sql is None:
+            sql = self._upserts[(table, columns, key)] = 'insert into `%s` (%s) values (%s) on conflict(`%s`) do update set %s' % (
+                table, ', '.join('`%s`' % c for c in columns), ', '.join(['%s'] * len(columns)), key,
+                ', '.join('`%s`=excluded.`%s`' % (c, c) for c in columns if c != key))
+        return sql
+
+
+class SQLitePool(object):
+    def __init__(self, path, maxsize=10, minsize=1):
+        self._tmpdir = None
+        if path == ':memory:':
+            self._tmpdir = tempfile.mkdtemp(prefix='awesome-')
+            path = os.path.join(self._tmpdir, 'awesome.db')
+        self._path = path
+        self.maxsize = maxsize
+        self.minsize = minsize
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxsize)
+        self._free = collections.deque()
+        self._used = set()
+        self._connecting = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._connecting
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _open(self):
+        db = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False)
+        db.execute('pragma busy_timeout=5000')
+        db.execute('pragma journal_mode=wal')
+        return db
+
+    async def _connect(self):
+        self._connecting += 1
+        try:
+            return SQLiteConnection(await self.run(self._open), self)
+        finally:
+            self._connecting -= 1
+
+    async def fill(self):
+        while self.size < self.minsize:
+            self._free.append(await self._connect())
+
+    async def acquire(self):
+        async with self._cond:
+            while not self._free and self.size >= self.maxsize:
+                await self._cond.wait()
+            conn = self._free.popleft() if self._free else await self._connect()
+            self._used.add(conn)
+            return conn
+
+    async def release(self, conn):
+        self._used.discard(conn)
+        if not conn.closed and conn.db.in_transaction:
+            logging.warning('Connection %r is in transaction, closing it.' % conn)
+            conn.close()
+        if conn.closed:
+            await self.run(conn.db.close)
+        else:
+            self._free.append(conn)
+        async with self._cond:
+            self._cond.notify()
+
+    def get(self):
+        return _PoolConnectionContext(self)
+
+    def close(self):
+        while self._free:
+            self._free.popleft().db.close()
+
+    async def wait_closed(self):
+        self._executor.shutdown(wait=False)
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+class _PoolConnectionContext(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._pool.release(self._conn)
+        self._conn = None
+
+
+# 和aiomysql的连接、游标用法一致：begin/commit/rollback/close，游标可以await也可以async with
+class SQLiteConnection(object):
+    def __init__(self, db, pool):
+        self.db = db
+        self.closed = False
+        self._pool = pool
+
+    def cursor(self, as_tuple=False):
+        return SQLiteCursor(self, as_tuple)
+
+    async def _exec(self, sql):
+        await self._pool.run(self.db.execute, sql)
+
+    # 事务一开始就拿写锁：默认的deferred事务先读后写时要把读锁升级成写锁，
+    # 升级失败SQLite不会等busy_timeout，直接报database is locked
+    async def begin(self):
+        await self._exec('begin immediate')
+
+    async def commit(self):
+        if self.db.in_transaction:
+            await self._exec('commit')
+
+    async def rollback(self):
+        if self.db.in_transaction:
+            await self._exec('rollback')
+
+    async def ping(self, reconnect=True):
+        await self._exec('select 1')
+
+    def close(self):
+        self.closed = True
+
+
+class SQLiteCursor(object):
+    def __init__(self, conn, as_tuple):
+        self._conn = conn
+        self._as_tuple = as_tuple
+        self._cur = None
+        self.rowcount = -1
+
+    def __await__(self):
+        yield from []
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def execute(self, sql, args=None):
+        def run():
+            cur = self._conn.db.cursor()
+            cur.execute(sql, tuple(args or ()))
+            return cur
+        self._cur = await self._conn._pool.run(run)
+        self.rowcount = self._cur.rowcount
+        return self.rowcount
+
+    def _wrap(self, rows):
+        if self._as_tuple:
+            return rows
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchall(self):
+        return self._wrap(await self._conn._pool.run(self._cur.fetchall))
+
+    async def fetchmany(self, size=None):
+        return self._wrap(await self._conn._pool.run(self._cur.fetchmany, size or 1))
+
+    async def close(self):
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+
+
+_drivers = dict(mysql=MySQLDriver, sqlite=SQLiteDriver)
+
+
+def get_driver(name):
+    if name not in _drivers:
+        raise ValueError('Invalid database driver: %s' % name)
+    return _drivers[name]()
@@ -1,13 +1,16 @@
 import re, time, json, logging, hashlib, base64, asyncio
 from www.coroweb import get, post
 from www.models import User, Comment, Blog, next_id
+from www.orm import gather
 from aiohttp import web
-from www.apis import APIError, APIValueError, APIResourceNotFoundError, Page, APIPermissionError
+from www.apis import APIError, APIValueError, APIResourceNotFoundError, APIPermissionError, CursorPage, decode_cursor
 from www.config import configs
 import www.markdown2
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
+# 日志列表页只显示这些列，不用把content大字段从数据库里读出来
+_BLOG_LIST_COLUMNS = ('id', 'user_id', 'user_name', 'name', 'summary', 'created_at')
 
 
 def check_admin(request):
@@ -26,6 +29,29 @@ def get_page_index(page_str):
     return p
 
 
+def get_cursor(token, name):
+    if not token:
+        return None
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        raise APIValueError(name, 'Invalid cursor.')
+
+
+# JSON接口传了after或before游标时走键集分页，按(created_at, id)倒序，不再用limit offset
+async def get_cursor_page(model, after, before, page_size=10, columns=None, compact=False, prefetch=None):
+    after, before = get_cursor(after, 'after'), get_cursor(before, 'before')
+    items, has_more = await model.findSeek(after=after, before=before, limit=page_size, columns=columns, compact=compact,
+                                           prefetch=prefetch)
+    if before is not None:
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, after is not None
+    first = (items[0].created_at, items[0].id) if items else None
+    last = (items[-1].created_at, items[-1].id) if items else None
+    return CursorPage(first, last, page_size, has_next, has_previous), items
+
+
 def user2cookie(user, max_age):
     expires = str(int(time.time()) + max_age)
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
@@ -64,15 +90,12 @@ async def cookie2user(cookie_str):
         return None
 
 
-@get('/')
+@get('/', timeout=3)
 async def index(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    page = Page(num)  # Page类能根据总条数返回page.offset,和page.limit
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+    # Page类能根据总条数返回page.offset,和page.limit
+    # 首页对所有访客都一样，直到有人发表或修改日志，用查询结果缓存
+    page, blogs = await Blog.findPage(get_page_index(page), orderBy='created_at desc', columns=_BLOG_LIST_COLUMNS,
+                                      prefetch=['comment_count'], cache=True)
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -82,8 +105,9 @@ async def index(*, page='1'):
 
 @get('/blog/{id}')
 async def get_blog(id):
-    blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    # 日志和评论互不依赖，并发查询；热门日志被大量同时访问时，相同的评论查询只发一条
+    blog, comments = await gather(Blog.find(id),
+                                  Comment.findAll('blog_id=?', [id], orderBy='created_at desc', single_flight=True))
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = www.markdown2.markdown(blog.content)
@@ -190,14 +214,12 @@ def manage_users(*, page='1'):
     }
 
 
-@get('/api/comments')
-async def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@get('/api/comments', timeout=5)
+async def api_comments(*, page='1', after=None, before=None):
+    if after is not None or before is not None:
+        p, comments = await get_cursor_page(Comment, after, before, compact=True, prefetch=['blog'])
+        return dict(page=p, comments=comments)
+    p, comments = await Comment.findPage(get_page_index(page), orderBy='created_at desc', compact=True, prefetch=['blog'])
     return dict(page=p, comments=comments)
 
 
@@ -212,7 +234,7 @@ async def api_create_comment(id, request, *, content):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    await comment.save_later()  # 配置了write_behind时写进本地日志就返回，稍后批量入库
     return comment
 
 
@@ -226,14 +248,14 @@ async def api_delete_comments(id, request):
     return dict(id=id)
 
 
-@get('/api/users')
-async def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@get('/api/users', timeout=5)
+async def api_get_users(*, page='1', after=None, before=None):
+    if after is not None or before is not None:
+        p, users = await get_cursor_page(User, after, before, compact=True)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
+    p, users = await User.findPage(get_page_index(page), orderBy='created_at desc', compact=True)
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
@@ -268,14 +290,12 @@ async def api_register_user(*, email, name, passwd):
     return r
 
 
-@get('/api/blogs')
-async def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@get('/api/blogs', timeout=5)
+async def api_blogs(*, page='1', after=None, before=None):
+    if after is not None or before is not None:
+        p, blogs = await get_cursor_page(Blog, after, before, columns=_BLOG_LIST_COLUMNS)
+        return dict(page=p, blogs=blogs)
+    p, blogs = await Blog.findPage(get_page_index(page), orderBy='created_at desc', columns=_BLOG_LIST_COLUMNS)
     return dict(page=p, blogs=blogs)
 
 
@@ -0,0 +1,202 @@
+# 主键ID生成器
+# 原来的next_id()生成50个字符的字符串(15位毫秒时间戳+32位uuid4+'000')，主键和blog_id/user_id这些外键列都是varchar(50)，
+# InnoDB的每个二级索引都要带上主键，ID越长索引越大。这里提供一个ULID风格的生成器：
+# 48位毫秒时间戳 + 80位随机数，用Crockford base32编码成26个字符(或者16字节的二进制)，按生成时间排序(k-sortable)。
+# 同一毫秒内生成的ID在随机数部分加1，保证同一个进程里严格递增；不同进程、不同机器靠80位随机数避免冲突，
+# fork出来的子进程会重新取随机数，不会和父进程生成同样的序列。
+#
+# 用法：
+#   www.ids.set_id_generator('ulid')     切换生成器，默认还是'legacy'，app启动时按configs.ids.generator设置
+#   python -m www.ids bench [n]          比较两种格式的插入速度和索引大小
+#   python -m www.ids migrate [--execute]   把blogs和comments的ID改成ULID(不带--execute只打印计划)
+import os
+import sys
+import time
+import uuid
+import asyncio
+import logging
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_DECODE = dict((c, i) for i, c in enumerate(_CROCKFORD))
+
+
+class LegacyGenerator(object):
+    length = 50
+
+    def generate(self):
+        return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+    def from_timestamp(self, ts):
+        return '%015d%s000' % (int(ts * 1000), uuid.uuid4().hex)
+
+
+class ULIDGenerator(object):
+    length = 26
+
+    def __init__(self):
+        self._pid = None
+        self._last_ms = -1
+        self._last_random = 0
+
+    def generate(self):
+        ms = int(time.time() * 1000)
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._last_ms = -1
+        if ms <= self._last_ms:
+            # 同一毫秒(或者时钟回拨)时沿用上一个时间戳，随机数加1，保证递增
+            ms = self._last_ms
+            self._last_random += 1
+            if self._last_random >= 1 << 80:
+                ms += 1
+                self._last_random = int.from_bytes(os.urandom(10), 'big') >> 1
+        else:
+            self._last_random = int.from_bytes(os.urandom(10), 'big') >> 1  # 留出加1的余地
+        self._last_ms = ms
+        return encode((ms << 80) | self._last_random)
+
+    # 按给定的时间生成ID，迁移旧数据时用created_at生成，新ID的顺序和原来的创建时间一致
+    def from_timestamp(self, ts):
+        return encode((int(ts * 1000) << 80) | int.from_bytes(os.urandom(10), 'big'))
+
+
+def encode(value):
+    chars = []
+    for i in range(26):
+        chars.append(_CROCKFORD[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def decode(s):
+    value = 0
+    for c in s.upper():
+        value = (value << 5) | _DECODE[c]
+    return value
+
+
+# ULID的二进制形式，存成binary(16)时用
+def to_bytes(s):
+    return decode(s).to_bytes(16, 'big')
+
+
+def from_bytes(b):
+    return encode(int.from_bytes(b, 'big'))
+
+
+def timestamp(s):
+    return (decode(s) >> 80) / 1000.0
+
+
+_generators = dict(legacy=LegacyGenerator, ulid=ULIDGenerator)
+__generator = LegacyGenerator()
+
+
+def set_id_generator(generator):
+    global __generator
+    if isinstance(generator, str):
+        if generator not in _generators:
+            raise ValueError('Invalid id generator: %s' % generator)
+        generator = _generators[generator]()
+    __generator = generator
+    logging.info('use id generator: %s' % generator.__class__.__name__)
+
+
+def get_id_generator():
+    return __generator
+
+
+def next_id():
+    return __generator.generate()
+
+
+async def bench(loop, n):
+    import www.orm
+    from www.config import configs
+    await www.orm.create_pool(loop=loop, **configs.db)
+    t0 = time.time()
+    for i in range(n):
+        LegacyGenerator().generate()
+    t1 = time.time()
+    g = ULIDGenerator()
+    for i in range(n):
+        g.generate()
+    t2 = time.time()
+    print('generate %s ids: legacy %.3fs, ulid %.3fs' % (n, t1 - t0, t2 - t1))
+    formats = [
+        ('legacy', 'varchar(50)', LegacyGenerator().generate),
+        ('ulid', 'char(26)', g.generate),
+        ('ulid_binary', 'binary(16)', lambda: to_bytes(g.generate())),
+    ]
+    for name, ddl, gen in formats:
+        table = 'bench_ids_%s' % name
+        await www.orm.execute('drop table if exists `%s`' % table, ())
+        await www.orm.execute('create table `%s` (`id` %s not null, `ref` %s not null, primary key (`id`), key (`ref`)) '
+                              'engine=innodb' % (table, ddl, ddl), ())
+        refs = [gen() for i in range(100)]
+        statements = []
+        start = time.time()
+        for i in range(0, n, 500):
+            rows = min(500, n - i)
+            args = []
+            for j in range(rows):
+                args.extend([gen(), refs[j % 100]])
+            statements.append(('insert into `%s` (`id`, `ref`) values %s' % (
+                table, ', '.join(['(%s, %s)'] * rows)), args))
+        await www.orm.execute_batches(statements)
+        elapsed = time.time() - start
+        await www.orm.select('analyze table `%s`' % table, ())
+        # MySQL 8.0的information_schema返回大写的列名，起个小写的别名
+        rs = await www.orm.select('select data_length as data_length, index_length as index_length from information_schema.tables '
+                                  'where table_schema=database() and table_name=%s', [table], 1)
+        print('%-12s %-12s insert %s rows: %.3fs (%.0f rows/s), data %s bytes, secondary index %s bytes' % (
+            name, ddl, n, elapsed, n / elapsed, rs[0]['data_length'], rs[0]['index_length']))
+        await www.orm.execute('drop table `%s`' % table, ())
+
+
+# 把blogs和comments的主键换成按created_at生成的ULID，同时改写comments.blog_id，最后把列改成char(26)。
+# users不迁移：用户密码的sha1里带着用户ID，改了ID就登录不了了。迁移期间应该停止写入，迁移后重启应用清空缓存。
+async def migrate(loop, execute=False):
+    import www.orm
+    from www.config import configs
+    await www.orm.create_pool(loop=loop, **configs.db)
+    if www.orm.shard_pools('comments'):
+        # blog_id是评论的分片键，改了以后评论就不在它该在的分片上了
+        print('comments are sharded, migrate each shard before enabling shards')
+        return
+    g = ULIDGenerator()
+    blogs = await www.orm.select('select `id`, `created_at` from `blogs`', ())
+    comments = await www.orm.select('select `id`, `created_at` from `comments`', ())
+    statements = []
+    for r in blogs:
+        new_id = g.from_timestamp(r['created_at'])
+        statements.append(('update `blogs` set `id`=%s where `id`=%s', [new_id, r['id']]))
+        statements.append(('update `comments` set `blog_id`=%s where `blog_id`=%s', [new_id, r['id']]))
+    for r in comments:
+        statements.append(('update `comments` set `id`=%s where `id`=%s', [g.from_timestamp(r['created_at']), r['id']]))
+    alters = [
+        'alter table `blogs` modify `id` char(26) not null',
+        'alter table `comments` modify `id` char(26) not null, modify `blog_id` char(26) not null',
+    ]
+    print('%s blogs, %s comments, %s updates' % (len(blogs), len(comments), len(statements)))
+    for sql in alters:
+        print(sql)
+    if not execute:
+        print('dry run, add --execute to migrate')
+        return
+    await www.orm.execute_batches(statements)
+    for sql in alters:
+        await www.orm.execute(sql, ())
+    print('migrated, set ids.generator to ulid and restart the app')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'bench'
+    loop = asyncio.get_event_loop()
+    if command == 'bench':
+        loop.run_until_complete(bench(loop, int(sys.argv[2]) if len(sys.argv) > 2 else 10000))
+    elif command == 'migrate':
+        loop.run_until_complete(migrate(loop, '--execute' in sys.argv))
+    else:
+        print('usage: python -m www.ids [bench [n]|migrate [--execute]]')
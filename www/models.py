@@ -1,10 +1,11 @@
 import time
-import uuid
-from www.orm import Model, StringField, BooleanField, FloatField, TextField
+import www.ids
+from www.orm import Model, StringField, BooleanField, FloatField, TextField, BelongsTo, HasMany, CountOf
 
 
+# 具体用哪种ID由www.ids里设置的生成器决定，默认还是原来50个字符的格式
 def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+    return www.ids.next_id()
 
 # 当用户定义一个class User(Model)时，Python解释器首先在当前类User的定义中查找metaclass，如果没有找到，
 # 就继续在父类Model中查找metaclass，找到了，就使用Model中定义的metaclass的ModelMetaclass来创建User类，
@@ -13,18 +14,23 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(maxsize=10000, ttl=60)  # cookie2user每个请求都要按主键查用户
+    __counters__ = ()
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(maxsize=1000, ttl=60)
+    __counters__ = ()
+    __single_flight__ = True  # 热门日志会被同时大量访问
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -33,11 +39,17 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+
+    comments = HasMany('Comment', 'blog_id', orderBy='created_at desc')
+    comment_count = CountOf('Comment', 'blog_id')  # 首页显示评论数
 
 
 class Comment(Model):
     __table__ = 'comments'
+    __counters__ = ('blog_id',)
+    __indexes__ = [('blog_id', 'created_at')]  # get_blog: blog_id=? order by created_at desc
+    __shard_key__ = 'blog_id'  # 配置了db.shards时，一篇日志的评论都在同一个分片上
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -45,34 +57,6 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    created_at = FloatField(default=time.time, index=True)
 
+    blog = BelongsTo('Blog', 'blog_id', columns=('id', 'name'))  # 后台评论列表显示日志标题
@@ -1,78 +1,1047 @@
+import os
+import re
+import json
+import time
+import zlib
+import random
+import weakref
 import asyncio
 import logging
-import aiomysql
+import functools
+import contextlib
+import contextvars
+import collections.abc
+from www.apis import Page
+from www.drivers import get_driver
 
 
-def log(sql, args=()):
-    logging.info('SQL:%s' % sql)
+__pool = None  # 主库连接池，所有写操作都走这里
+__replicas = []  # 只读从库的连接池，select在这些池之间做负载均衡
+__replica_policy = 'round_robin'
+__replica_next = 0
+__read_your_writes = 0  # 写之后多少秒内，同一个会话的读也走主库，0表示不启用
+__last_writes = dict()  # 会话key -> 最近一次写的时间
+__shards = dict()  # 表名 -> 分片的连接池列表，见Model.__shard_key__
+__shard_pools = set()  # 所有分片的连接池
+
+# 当前请求所属的会话，通常是登录用户的id，由app的中间件设置；
+# 没有设置时(匿名请求、后台任务)不记录写入，不然一次后台写入会把所有匿名请求的读都赶到主库去
+_consistency_key = contextvars.ContextVar('orm_consistency_key', default=None)
+
+
+def set_consistency_key(key):
+    _consistency_key.set(key)
+
+
+# 当前协程所在的事务，事务里的所有语句都用同一个连接
+_transaction = contextvars.ContextVar('orm_transaction', default=None)
+
+# 当前请求的截止时间(time.monotonic()的值)，由coroweb按路由的timeout设置
+_deadline = contextvars.ContextVar('orm_deadline', default=None)
+
+
+# 查询超过了请求的截止时间
+class QueryTimeoutError(Exception):
+    pass
+
+
+# 用法：with orm.deadline(3): ... 里面的所有查询加起来不能超过3秒；嵌套时以更早的截止时间为准
+@contextlib.contextmanager
+def deadline(seconds):
+    d = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(d if current is None else min(d, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+# 离截止时间还剩多少秒，没有截止时间返回None，已经过了就直接抛QueryTimeoutError
+def _remaining():
+    d = _deadline.get()
+    if d is None:
+        return None
+    remaining = d - time.monotonic()
+    if remaining <= 0:
+        raise QueryTimeoutError('request deadline exceeded')
+    return remaining
+
+
+# 在截止时间内等待一条语句执行完。超时或者请求被取消时，让数据库终止这条语句，
+# 并关掉这个连接(它的协议状态已经不确定了)，连接池会丢弃它
+async def _within_deadline(conn, coro, timeout):
+    try:
+        if timeout is None:
+            return await coro
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        await _abort(conn)
+        raise QueryTimeoutError('query cancelled after %.3fs: request deadline exceeded' % timeout)
+    except asyncio.CancelledError:
+        await _abort(conn)
+        raise
+    except Exception as e:
+        if timeout is not None and __driver.timed_out(e):  # 数据库按with_timeout的提示自己终止了语句
+            raise QueryTimeoutError('query cancelled by server after %.3fs: request deadline exceeded' % timeout) from e
+        raise
+
+
+async def _abort(conn):
+    try:
+        await __driver.kill(conn)
+    except Exception as e:
+        logging.warning('failed to kill query: %s' % e)
+    conn.close()
+
+
+__driver = None  # 当前使用的数据库驱动，见www.drivers
+
+
+# 类的方法里不能直接写__driver(会被改名)，通过这个函数拿
+def _get_driver():
+    return __driver
 
 
 # 创建一个全局的连接池，每个http请求都从池中获得数据库连接
+# shards={'comments': [{'host': ...}, ...]}给设置了__shard_key__的Model的表分片，每个分片的配置缺省项沿用主库的配置；
+# 行按分片键的哈希值对分片数取模分配，分片数定下来以后就不能再改
+# driver='mysql'(默认，用aiomysql)或'sqlite'(用path指定数据库文件，':memory:'表示内存数据库)
+# kw里可以带replicas=[{'host': ...}, ...]，每个从库的配置缺省项沿用主库的配置，各自建一个连接池；
+# replica_policy选择从库的方式：round_robin轮询，least_busy挑正在使用的连接最少的那个；
+# read_your_writes=秒数，写之后这段时间内同一会话的读走主库，保证用户刚发的评论马上能看到
+# slow_query={'threshold': 秒, 'sample_rate': 0~1, 'explain': True/False}，见configure_slow_log
+# query_cache={'maxsize': 条数, 'ttl': 秒}，findAll/findNumber/findPage传cache=True时使用的结果缓存
+# fanout_limit=orm.gather一个请求最多同时占用的连接数
+# warmup=每个池启动时预先建好的连接数，checkout_timeout=借连接最多等的秒数，ping_after=空闲多少秒的连接借出前要ping
 async def create_pool(loop, **kw):
     logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 20),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
-
-
-async def select(sql, args, size=None):
-    log(sql, args)  # 每次执行查询前，记录sql语句日志
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())  # 应该是执行带参数的sql语句，先是把？占位符替换成%s。
-            if size:
-                rs = await cur.fetchmany(size)
+    global __pool, __replicas, __replica_policy, __read_your_writes, __driver, __checkout_timeout, __ping_after
+    global __fanout_limit, __shards, __shard_pools
+    __driver = get_driver(kw.pop('driver', 'mysql'))
+    _window_functions(__driver.window_functions)
+    replicas = kw.pop('replicas', None) or []
+    shards = kw.pop('shards', None) or {}
+    if replicas and __driver.name == 'sqlite':
+        logging.warning('replicas are not supported by sqlite driver, ignored.')
+        replicas = []
+    __replica_policy = kw.pop('replica_policy', 'round_robin')
+    if __replica_policy not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid replica_policy value: %s' % __replica_policy)
+    __read_your_writes = kw.pop('read_your_writes', 0)
+    check_indexes(kw.pop('check_indexes', False))
+    configure_slow_log(**kw.pop('slow_query', {}))
+    query_cache.configure(**kw.pop('query_cache', {}))
+    __checkout_timeout = kw.pop('checkout_timeout', None)
+    __ping_after = kw.pop('ping_after', 30)
+    __fanout_limit = kw.pop('fanout_limit', 4)
+    warmup = kw.pop('warmup', 0)
+    __pool = await __driver.create_pool(loop, kw)
+    __pool_metrics.clear()
+    __pool_metrics[__pool] = PoolMetrics('primary', __pool)
+    __replicas = []
+    for i, replica in enumerate(replicas):
+        logging.info('create replica connection pool: %s' % replica.get('host', kw.get('host', 'localhost')))
+        pool = await __driver.create_pool(loop, dict(kw, **replica))
+        __pool_metrics[pool] = PoolMetrics('replica-%d' % i, pool)
+        __replicas.append(pool)
+    __shards = dict()
+    __shard_pools = set()
+    for table, configs in shards.items():
+        __shards[table] = []
+        for i, shard in enumerate(configs):
+            logging.info('create shard connection pool: %s-%d' % (table, i))
+            pool = await __driver.create_pool(loop, dict(kw, **shard))
+            __pool_metrics[pool] = PoolMetrics('%s-%d' % (table, i), pool)
+            __shards[table].append(pool)
+            __shard_pools.add(pool)
+    if warmup:
+        await asyncio.gather(*[_warmup(pool, warmup) for pool in __pool_metrics])
+        logging.info('connection pools warmed up: %s' % ', '.join('%s=%s' % (m.name, m.pool.size) for m in __pool_metrics.values()))
+
+
+# 慢查询日志：每条语句都计时，按语句的形状(去掉参数和字面量以后的SQL)汇总到query_stats里。
+# 超过threshold秒的语句记为慢查询，按sample_rate抽样写日志；explain=True时对慢的select自动执行一次EXPLAIN，
+# 每种形状只EXPLAIN一次，结果保存在query_stats里
+__slow_threshold = 0.2
+__slow_sample_rate = 1.0
+__slow_explain = False
+
+
+def configure_slow_log(threshold=0.2, sample_rate=1.0, explain=False):
+    global __slow_threshold, __slow_sample_rate, __slow_explain
+    __slow_threshold = threshold
+    __slow_sample_rate = sample_rate
+    __slow_explain = explain
+
+
+_RE_SQL_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_RE_SQL_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_SQL_IN_LIST = re.compile(r'\b(in|values)\s*\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*', re.I)
+_RE_SQL_SPACE = re.compile(r'\s+')
+
+
+# 把SQL归一成形状：字面量和占位符都变成?，in (?, ?, ...)和多行的values (...), (...)不管多少个参数都算同一种
+def sql_shape(sql):
+    shape = sql.replace('%s', '?')
+    shape = _RE_SQL_STRING.sub('?', shape)
+    shape = _RE_SQL_NUMBER.sub('?', shape)
+    shape = _RE_SQL_IN_LIST.sub(r'\1 (...)', shape)
+    return _RE_SQL_SPACE.sub(' ', shape).strip()
+
+
+class QueryStats(object):
+    def __init__(self, max_shapes=1000, max_slow=100):
+        self.max_shapes = max_shapes
+        self._shapes = dict()  # sql -> 形状，Model的语句是编译好反复用的，归一化只做一次
+        self._stats = dict()  # 形状 -> {'count', 'total', 'max', 'slow', 'explain'}
+        self.slow = collections.deque(maxlen=max_slow)  # 最近的慢查询：(时间, 形状, 耗时)
+
+    def shape(self, sql):
+        shape = self._shapes.get(sql)
+        if shape is None:
+            shape = sql_shape(sql)
+            if len(self._shapes) < self.max_shapes * 4:
+                self._shapes[sql] = shape
+        return shape
+
+    # 返回这种形状的统计项，形状太多时不再增加新的，全部算到'(other)'里
+    def record(self, sql, elapsed, slow=False):
+        shape = self.shape(sql)
+        st = self._stats.get(shape)
+        if st is None:
+            if len(self._stats) >= self.max_shapes:
+                shape = '(other)'
+            st = self._stats.setdefault(shape, dict(count=0, total=0.0, max=0.0, slow=0, explain=None))
+        st['count'] += 1
+        st['total'] += elapsed
+        if elapsed > st['max']:
+            st['max'] = elapsed
+        if slow:
+            st['slow'] += 1
+            self.slow.append((time.time(), shape, elapsed))
+        return shape, st
+
+    def get(self, sql):
+        return self._stats.get(self.shape(sql))
+
+    # 按key排序的前n种形状，key可以是count/total/max/slow/avg
+    def top(self, n=10, key='total'):
+        rows = [dict(st, shape=shape, avg=st['total'] / st['count']) for shape, st in self._stats.items()]
+        rows.sort(key=lambda r: r[key], reverse=True)
+        return rows[:n]
+
+    def snapshot(self):
+        return {shape: dict(st) for shape, st in self._stats.items()}
+
+    def reset(self):
+        self._stats.clear()
+        self.slow.clear()
+
+
+query_stats = QueryStats()
+
+
+# 每条语句执行完调用，elapsed是从发出语句到取完结果的秒数
+def _record_query(sql, args, elapsed):
+    slow = elapsed >= __slow_threshold
+    shape, st = query_stats.record(sql, elapsed, slow)
+    if not slow or (__slow_sample_rate < 1 and random.random() >= __slow_sample_rate):
+        return
+    logging.warning('slow query (%.3fs): %s' % (elapsed, shape))
+    if __slow_explain and st['explain'] is None and shape.lower().startswith('select'):
+        st['explain'] = ()  # 占位，避免并发的慢查询重复EXPLAIN
+        asyncio.ensure_future(_explain(st, sql, args))
+
+
+async def _explain(st, sql, args):
+    _transaction.set(None)  # 在独立的连接上执行，不占用调用方事务的连接
+    try:
+        async with _connection(_read_pool()) as conn:
+            async with __driver.cursor(conn, True) as cur:
+                await cur.execute(__driver.sql(__driver.explain + sql), args or ())
+                st['explain'] = tuple(await cur.fetchall())
+        logging.warning('explain %s: %s' % (sql, st['explain']))
+    except Exception as e:
+        logging.warning('explain failed: %s' % e)
+
+
+# 分片的Model不能按分片键路由时(比如跨分片的事务、不能在内存里合并的聚合和排序)抛这个异常
+class ShardingError(Exception):
+    pass
+
+
+# table这张表的分片连接池列表，没有分片返回None
+def shard_pools(table):
+    return __shards.get(table)
+
+
+def _shard_index(value, n):
+    return zlib.crc32(str(value).encode('utf-8')) % n
+
+
+_RE_OR = re.compile(r'\bor\b', re.I)
+_shard_key_patterns = dict()
+
+
+# 从where里找"分片键=?"对应的参数值，找不到(或者where里有or，不能确定)返回None
+def _shard_value(key, where, args):
+    if not where or not args or _RE_OR.search(where):
+        return None
+    pattern = _shard_key_patterns.get(key)
+    if pattern is None:
+        pattern = _shard_key_patterns[key] = re.compile(r'(?<![\w.`])`?%s`?\s*=\s*\?' % re.escape(key))
+    m = pattern.search(where)
+    if m is None:
+        return None
+    return args[where.count('?', 0, m.start())]
+
+
+_RE_ORDER_ITEM = re.compile(r'^`?(\w+)`?(?:\s+(asc|desc))?$', re.I)
+
+
+# 把orderBy拆成[(列名, 是否倒序), ...]，跨分片的结果要按它在内存里归并；带函数、表达式的排序没法归并
+def _order_columns(orderBy):
+    order = []
+    if not orderBy:
+        return order
+    for item in orderBy.split(','):
+        m = _RE_ORDER_ITEM.match(item.strip())
+        if m is None:
+            raise ShardingError('Cannot merge order by %s across shards' % orderBy)
+        order.append((m.group(1), (m.group(2) or '').lower() == 'desc'))
+    return order
+
+
+# 按order排序，紧凑行(元组)按columns里的位置取值；NULL和数据库一样排在最小的位置
+def _sort_rows(rows, order, columns=None):
+    for col, desc in reversed(order):  # sort是稳定的，从最次要的列开始排
+        i = columns.index(col) if columns else col
+        rows.sort(key=lambda r: (r[i] is not None, r[i]), reverse=desc)
+    return rows
+
+
+# 跨分片的findNumber怎么合并各分片的结果
+_MERGE_NUMBER = dict(count=sum, sum=sum, max=max, min=min)
+
+
+__window_functions = True  # 数据库是否支持count(*) over()，create_pool时按驱动设置，MySQL第一次执行失败后置为False
+
+
+def _window_functions(supported=None):
+    global __window_functions
+    if supported is not None:
+        __window_functions = supported
+    return __window_functions
+
+
+# 类的方法里不能直接写__pool(会被改名成_类名__pool)，统一通过这个函数拿主库连接池
+def _write_pool():
+    return __pool
+
+
+def _mark_write():
+    key = _consistency_key.get()
+    if __read_your_writes and key is not None:
+        now = time.monotonic()
+        if len(__last_writes) > 10000:
+            for k in [k for k, t in __last_writes.items() if now - t > __read_your_writes]:
+                del __last_writes[k]
+        __last_writes[key] = now
+
+
+# 读操作用哪个连接池：没有从库、或者当前会话刚写过，就用主库
+def _read_pool():
+    global __replica_next
+    if not __replicas:
+        return __pool
+    if __read_your_writes:
+        t = __last_writes.get(_consistency_key.get())
+        if t is not None and time.monotonic() - t < __read_your_writes:
+            return __pool
+    if __replica_policy == 'least_busy':
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    __replica_next = (__replica_next + 1) % len(__replicas)
+    return __replicas[__replica_next]
+
+
+# 从连接池借连接等太久时抛出，而不是一直等下去
+class PoolTimeoutError(Exception):
+    pass
+
+
+__checkout_timeout = None  # 借连接最多等多少秒，None表示一直等
+__ping_after = 30  # 连接空闲超过多少秒，借出去之前先ping一下，坏了就换一个
+__idle_since = weakref.WeakKeyDictionary()  # 连接 -> 还回连接池的时间
+__pool_metrics = dict()  # 连接池 -> PoolMetrics
+
+_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # 等待时间直方图的上界(秒)
+
+
+class PoolMetrics(object):
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.waiters = 0  # 正在等连接的协程数
+        self.checkouts = 0
+        self.timeouts = 0
+        self.errors = 0  # 建连接、ping失败的次数
+        self.wait_total = 0.0
+        self.wait_buckets = [0] * (len(_WAIT_BUCKETS) + 1)
+
+    def observe_wait(self, elapsed):
+        self.checkouts += 1
+        self.wait_total += elapsed
+        for i, bound in enumerate(_WAIT_BUCKETS):
+            if elapsed <= bound:
+                self.wait_buckets[i] += 1
+                return
+        self.wait_buckets[-1] += 1
+
+    def snapshot(self):
+        histogram = dict(('<=%s' % b, n) for b, n in zip(_WAIT_BUCKETS, self.wait_buckets))
+        histogram['+inf'] = self.wait_buckets[-1]
+        return dict(name=self.name, size=self.pool.size, maxsize=self.pool.maxsize,
+                    in_use=self.pool.size - self.pool.freesize, idle=self.pool.freesize,
+                    waiters=self.waiters, checkouts=self.checkouts, timeouts=self.timeouts,
+                    connection_errors=self.errors, wait_histogram=histogram,
+                    wait_avg=self.wait_total / self.checkouts if self.checkouts else 0.0)
+
+
+# 所有连接池的实时指标
+def pool_metrics():
+    return [m.snapshot() for m in __pool_metrics.values()]
+
+
+# 从连接池借一个连接：最多等checkout_timeout秒，空闲太久的连接先ping，ping不通就关掉再借
+async def _checkout(pool):
+    m = __pool_metrics[pool]
+    start = time.monotonic()
+    m.waiters += 1
+    try:
+        while True:
+            timeout = None
+            if __checkout_timeout is not None:
+                timeout = max(__checkout_timeout - (time.monotonic() - start), 0)
+            remaining = _remaining()  # 借连接的时间也算在请求的截止时间里
+            by_deadline = remaining is not None and (timeout is None or remaining < timeout)
+            try:
+                conn = await asyncio.wait_for(pool.acquire(), remaining if by_deadline else timeout)
+            except asyncio.TimeoutError:
+                m.timeouts += 1
+                if by_deadline:
+                    raise QueryTimeoutError('request deadline exceeded while waiting for %s pool' % m.name)
+                raise PoolTimeoutError('no free connection in %s pool after %ss' % (m.name, __checkout_timeout))
+            except Exception:
+                m.errors += 1
+                raise
+            idle = __idle_since.pop(conn, None)
+            if idle is None or time.monotonic() - idle < __ping_after:
+                break
+            try:
+                await conn.ping(False)
+                break
+            except Exception as e:
+                m.errors += 1
+                logging.warning('drop broken connection from %s pool: %s' % (m.name, e))
+                conn.close()
+                await pool.release(conn)
+    finally:
+        m.waiters -= 1
+    m.observe_wait(time.monotonic() - start)
+    return conn
+
+
+async def _checkin(pool, conn):
+    if not conn.closed:
+        __idle_since[conn] = time.monotonic()
+    await pool.release(conn)
+
+
+# 启动时先把连接建好，免得部署后的第一波请求都在等建连接
+async def _warmup(pool, size):
+    conns = await asyncio.gather(*[_checkout(pool) for n in range(min(size, pool.maxsize))])
+    for conn in conns:
+        await _checkin(pool, conn)
+
+
+# 事务的连接上还有没读完的流式查询时又要执行语句，抛这个异常：
+# 流式查询读完之前一直占着这个连接的锁，再等锁就永远等不到了
+class StreamOpenError(Exception):
+    pass
+
+
+# 取一个连接：在事务里就用事务固定的那个连接，否则从pool里借一个
+# 事务里用asyncio.gather并发执行语句时共用一个连接，用锁保证同一时间只有一条语句在这个连接上执行
+@contextlib.asynccontextmanager
+async def _connection(pool):
+    tx = _transaction.get()
+    if tx is not None:
+        if pool is not tx.pool and pool in __shard_pools:
+            raise ShardingError('statements on shard pools cannot run inside orm.transaction()')
+        if tx.streaming:
+            raise StreamOpenError('a streaming query is still open on this transaction, '
+                                  'read it into a list (or finish it) before running other statements')
+        async with tx.lock:
+            yield tx.conn
+    else:
+        conn = await _checkout(pool)
+        try:
+            yield conn
+        finally:
+            await _checkin(pool, conn)
+
+
+# 在事务里时推迟到事务结束(提交或回滚)后再执行，不在事务里就立刻执行，用来做缓存失效之类的善后
+def _after_transaction(fn):
+    tx = _transaction.get()
+    if tx is not None:
+        tx.callbacks.append(fn)
+    else:
+        fn()
+
+
+class Transaction(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.pool = None
+        self.lock = asyncio.Lock()
+        self.depth = 0
+        self.callbacks = []
+        self.streaming = 0  # 这个连接上正在进行的流式查询个数，见select_stream
+
+    async def _run(self, sql):
+        if self.streaming:
+            raise StreamOpenError('a streaming query is still open on this transaction')
+        async with self.lock:
+            async with _get_driver().cursor(self.conn, True) as cur:
+                await cur.execute(sql)
+
+
+# 用法：
+#   async with orm.transaction():
+#       await blog.save()
+#       await comment.save()
+# 事务里的save/update/remove、select、execute都复用同一个连接，正常退出时提交，抛异常时回滚。
+# 事务可以嵌套，内层用SAVEPOINT实现，内层出错只回滚到内层开始的地方。
+class transaction(object):
+    def __init__(self):
+        self._token = None
+        self._savepoint = None
+
+    async def __aenter__(self):
+        tx = _transaction.get()
+        if tx is not None:
+            tx.depth += 1
+            self._savepoint = 'sp_%d' % tx.depth
+            await tx._run('SAVEPOINT %s' % self._savepoint)
+            return tx
+        pool = _write_pool()
+        conn = await _checkout(pool)
+        try:
+            await conn.begin()
+        except BaseException:
+            await _checkin(pool, conn)
+            raise
+        tx = Transaction(conn)
+        tx.pool = pool
+        self._token = _transaction.set(tx)
+        return tx
+
+    async def __aexit__(self, exc_type, exc, tb):
+        tx = _transaction.get()
+        if self._savepoint is not None:
+            tx.depth -= 1
+            if exc_type is None:
+                await tx._run('RELEASE SAVEPOINT %s' % self._savepoint)
             else:
-                rs = await cur.fetchall()
-        logging.info('rows returned:%s' % len(rs))
+                await tx._run('ROLLBACK TO SAVEPOINT %s' % self._savepoint)
+            return False
+        _transaction.reset(self._token)
+        try:
+            if exc_type is None:
+                await tx.conn.commit()
+                _mark_write()
+            elif not tx.conn.closed:  # 语句超时被终止时连接已经关掉，事务由数据库回滚
+                await tx.conn.rollback()
+        finally:
+            await _checkin(tx.pool, tx.conn)
+            for fn in tx.callbacks:
+                fn()
+        return False
+
+
+# select和execute接收的sql都已经是%s占位符形式（Model的语句在元类和_compile里编译好），这里不再做字符串处理
+# as_tuple=True时返回元组行，不为每一行构造dict，配合Model的紧凑行对象使用
+# single_flight=True时，同样的SQL和参数正在执行的话不再另发一条，等着用它的结果(每个调用方拿到各自的一份拷贝)；
+# 事务里不合并，事务能看到自己没提交的写入
+# 共享的查询不属于哪一个调用方，在空的上下文里执行，不继承第一个调用方的截止时间，每个调用方各自按自己的截止时间等
+# pool指定查询哪个连接池(分片)，默认按读写分离的规则选
+async def select(sql, args, size=None, as_tuple=False, single_flight=False, pool=None):
+    pool = pool or _read_pool()
+    if not single_flight or _transaction.get() is not None:
+        return await _select(pool, sql, args, size, as_tuple)
+    # 读从库时不管轮询到了哪个从库都算同一个查询，用发起查询的那个调用方选的从库；
+    # 同一个会话刚写过时读主库，不能和读从库的合并
+    key = ('replica' if pool in __replicas else id(pool), sql, tuple(args or ()), size, as_tuple)
+    fut = __in_flight.get(key)
+    if fut is None:
+        fut = __in_flight[key] = _detached(_select(pool, sql, args, size, as_tuple))
+        fut.add_done_callback(functools.partial(_in_flight_done, key))
+    else:
+        __in_flight_stats['joined'] += 1
+    timeout = _remaining()
+    try:
+        # shield：某个调用方被取消或超时，不影响其他还在等的调用方
+        rs = await asyncio.wait_for(asyncio.shield(fut), timeout)
+    except asyncio.TimeoutError:
+        raise QueryTimeoutError('request deadline exceeded while waiting for shared query')
+    return list(rs) if as_tuple else [dict(r) for r in rs]
+
+
+__in_flight = dict()  # (连接池或'replica', sql, 参数, size, as_tuple) -> 正在执行的查询
+__in_flight_stats = dict(joined=0)  # 有多少次查询是合并到已经在执行的查询上的
+
+
+def _in_flight_done(key, fut):
+    __in_flight.pop(key, None)
+    if not fut.cancelled():
+        fut.exception()  # 等的调用方都超时走了的话，异常没人取，这里取一下免得asyncio报警告
+
+
+# 在空的上下文里启动任务：截止时间、会话、事务这些contextvars都是默认值
+def _detached(coro):
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+def single_flight_stats():
+    return dict(__in_flight_stats, in_flight=len(__in_flight))
+
+
+async def _select(pool, sql, args, size, as_tuple):
+    async with _connection(pool) as conn:
+        timeout = _remaining()
+        start = time.perf_counter()
+        async with __driver.cursor(conn, as_tuple) as cur:
+            async def run():
+                # sql已经是驱动需要的%s占位符形式，见Model._compile
+                await cur.execute(__driver.with_timeout(__driver.sql(sql), timeout), args or ())
+                if size:
+                    return await cur.fetchmany(size)
+                return await cur.fetchall()
+            rs = await _within_deadline(conn, run(), timeout)
+        _record_query(sql, args, time.perf_counter() - start)  # 每条语句都计时，慢的才写日志
         return rs
 
 
-async def execute(sql, args, autocommit=True):
-    log(sql)
-    async with __pool.get() as conn:
+# 流式查询：用服务端游标(SSDictCursor)每次只从MySQL取chunk_size行，结果集再大内存也不涨
+# 正常读完就把连接还给连接池；中途退出时游标里还有没读完的结果，这时直接关掉连接，
+# 连接池会丢弃这个连接并腾出名额，免得为了清空游标把剩下的整张表都读一遍
+# 事务里流式查询读完之前，同一个事务不能再执行别的语句(会抛StreamOpenError)
+async def select_stream(sql, args, chunk_size=1000, as_tuple=False, pool=None):
+    tx = _transaction.get()
+    async with _connection(pool or _read_pool()) as conn:
+        cur = await __driver.cursor(conn, as_tuple, stream=True)
+        if tx is not None:
+            tx.streaming += 1
+        try:
+            timeout = _remaining()
+            start = time.perf_counter()
+            await _within_deadline(conn, cur.execute(__driver.with_timeout(__driver.sql(sql), timeout), args or ()), timeout)
+            _record_query(sql, args, time.perf_counter() - start)  # 只算拿到第一批结果的时间，调用方处理行的时间不算
+            while True:
+                timeout = _remaining()
+                rs = await _within_deadline(conn, cur.fetchmany(chunk_size), timeout)
+                if not rs:
+                    break
+                for r in rs:
+                    yield r
+            await cur.close()
+        except BaseException:
+            # 事务里的连接不能关，只能把剩下的结果读完
+            if tx is not None:
+                await cur.close()
+            else:
+                conn.close()
+            raise
+        finally:
+            if tx is not None:
+                tx.streaming -= 1
+
+
+# autocommit=False时单独为这条语句开一个事务；已经在orm.transaction()里时由外层事务负责提交
+async def execute(sql, args, autocommit=True, pool=None):
+    if _transaction.get() is not None:
+        autocommit = True
+    async with _connection(pool or __pool) as conn:
+        timeout = _remaining()
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+            async with __driver.cursor(conn, True) as cur:
+                start = time.perf_counter()
+                await _within_deadline(conn, cur.execute(__driver.sql(sql), args), timeout)
+                _record_query(sql, args, time.perf_counter() - start)
                 affected = cur.rowcount
             if not autocommit:
                 await conn.commit()
         except BaseException as e:
-            if not autocommit:
-                await conn.roolback()
+            if not autocommit and not conn.closed:
+                await conn.rollback()
             raise
+        _mark_write()
         return affected
 
 
-# 函数定义：添加sql语句的占位符:?，在metaclass中的底层运用
-# 根据参数数量生成SQL占位符'?'列表，
+# 在同一个连接、同一个事务里依次执行多条语句，返回每条语句影响的行数，任何一条失败就整体回滚
+async def execute_batches(statements, pool=None):
+    counts = []
+    own = _transaction.get() is None  # 已经在事务里就不再自己开事务
+    async with _connection(pool or __pool) as conn:
+        if own:
+            await conn.begin()
+        try:
+            async with __driver.cursor(conn, True) as cur:
+                for sql, args in statements:
+                    start = time.perf_counter()
+                    timeout = _remaining()
+                    await _within_deadline(conn, cur.execute(__driver.sql(sql), args), timeout)
+                    _record_query(sql, args, time.perf_counter() - start)
+                    counts.append(cur.rowcount)
+            if own:
+                await conn.commit()
+        except BaseException:
+            if own and not conn.closed:
+                await conn.rollback()
+            raise
+    _mark_write()
+    return counts
+
+
+# 并发执行几个互不依赖的查询，各自从连接池借连接，按传入的顺序返回结果：
+#   blog, comments = await orm.gather(Blog.find(id), Comment.findAll('blog_id=?', [id]))
+# 一个请求同时最多占用fanout_limit个连接，免得一个请求把连接池借空；
+# 已经在gather的子任务里、或者在事务里(只有一个连接)时，按顺序执行，不再嵌套并发
+__fanout_limit = 4
+_fanning_out = contextvars.ContextVar('orm_fanning_out', default=False)
+
+
+async def gather(*aws):
+    if _fanning_out.get() or _transaction.get() is not None or len(aws) < 2:
+        results = []
+        try:
+            for aw in aws:
+                results.append(await aw)
+        except BaseException:
+            for aw in aws[len(results) + 1:]:
+                if asyncio.iscoroutine(aw):
+                    aw.close()  # 没执行到的协程关掉，免得报never awaited
+            raise
+        return results
+    sem = asyncio.Semaphore(__fanout_limit)
+
+    async def run(aw):
+        async with sem:
+            _fanning_out.set(True)  # 只影响这个子任务自己的上下文
+            return await aw
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()  # 一个失败了，其余的不用再等，尽快把连接还回去
+        raise
+
+
+# 函数定义：添加sql语句的占位符，在metaclass中的底层运用
+# 根据参数数量生成SQL占位符列表，直接生成驱动需要的%s，省得每次执行时再替换
 def create_args_string(num):
     L = []
     for n in range(num):
-        L.append('?')
+        L.append('%s')
     return ', '.join(L)
+
+
+# 把调用方写的?占位符换成驱动的%s，只在编译语句的时候做一次
+def to_driver_sql(sql):
+    return sql.replace('?', '%s')
+
+
+# 每个Model最多缓存多少种编译好的语句，防止调用方把参数拼进where导致缓存无限增长
+_SQL_CACHE_SIZE = 256
+
+
+def _limit_shape(limit):
+    if limit is None:
+        return 0
+    if isinstance(limit, int):
+        return 1
+    if isinstance(limit, tuple) and len(limit) == 2:
+        return 2
+    raise ValueError('Invalid limit value: %s' % str(limit))
+
+
+# 按最近使用淘汰的缓存，每个条目有ttl秒的有效期，记录命中、未命中和淘汰次数，方便线上调整大小
+class LRUCache(object):
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+# 查询结果缓存：key是最终的SQL和参数，按表打标签。每张表有一个版本号，save/update/remove时加一，
+# 版本号也是key的一部分，所以旧版本的结果再也不会被命中，由LRU和TTL慢慢淘汰。
+# 只对Model的save/update/remove/save_many生效，直接用execute改表的话要自己调用query_cache.bump(表名)
+class QueryCache(object):
+    def __init__(self, maxsize=1000, ttl=30):
+        self._lru = LRUCache(maxsize, ttl)
+        self._versions = dict()  # 表名 -> 版本号
+        self._tags = dict()  # 表名 -> {'hits', 'misses', 'invalidations'}
+
+    def configure(self, maxsize=1000, ttl=30):
+        self._lru = LRUCache(maxsize, ttl)
+
+    def key(self, tag, sql, args, *extra):
+        return (tag, self._versions.get(tag, 0), sql, tuple(args or ())) + extra
+
+    def _tag(self, tag):
+        st = self._tags.get(tag)
+        if st is None:
+            st = self._tags[tag] = dict(hits=0, misses=0, invalidations=0)
+        return st
+
+    def get(self, key):
+        value = self._lru.get(key)
+        self._tag(key[0])['misses' if value is None else 'hits'] += 1
+        return value
+
+    def put(self, key, value):
+        self._lru.put(key, value)
+
+    def bump(self, tag):
+        self._versions[tag] = self._versions.get(tag, 0) + 1
+        self._tag(tag)['invalidations'] += 1
+
+    def stats(self):
+        tags = dict()
+        for tag, st in self._tags.items():
+            total = st['hits'] + st['misses']
+            tags[tag] = dict(st, version=self._versions.get(tag, 0), hit_rate=st['hits'] / total if total else 0.0)
+        return dict(self._lru.stats(), tags=tags)
+
+
+query_cache = QueryCache()
+
+
+# 把短时间内对同一个Model的find(pk)攒成一批，用一条where pk in (...)查出来，再把每一行分给各自的调用方
+# window为0表示只攒当前这一轮事件循环里的请求，否则最多等window秒；攒够max_batch个立刻发出去
+class PkLoader(object):
+    def __init__(self, model, window=0, max_batch=512):
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = dict()  # (连接池, pk) -> future，同一个池上同一个pk的多个调用方共用一个future
+        self._scheduled = False
+
+    # 连接池在调用方的上下文里选：批量查询在空的上下文里执行，那里看不到调用方的会话，
+    # 刚写过的会话要读主库(read_your_writes)，不能和读从库的调用方合成一批；分片的Model由_select_any查所有分片
+    async def load(self, pk):
+        key = (None if self.model._shards() else _read_pool(), pk)
+        fut = self._pending.get(key)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            fut = self._pending[key] = loop.create_future()
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif not self._scheduled:
+                self._scheduled = True
+                if self.window:
+                    loop.call_later(self.window, self._dispatch)
+                else:
+                    loop.call_soon(self._dispatch)
+        # future是多个调用方共用的，shield防止其中一个调用方被取消或超时时连累其他人；每个调用方按自己的截止时间等
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), _remaining())
+        except asyncio.TimeoutError:
+            raise QueryTimeoutError('request deadline exceeded while waiting for batched find')
+
+    # 一批查询属于好几个调用方，在空的上下文里执行，不继承触发它的那个调用方的截止时间，见_detached
+    def _dispatch(self):
+        self._scheduled = False
+        pending, self._pending = self._pending, dict()
+        if pending:
+            _detached(self._run(pending))
+
+    # 每个连接池一条查询
+    async def _run(self, pending):
+        groups = dict()
+        for pool, pk in pending:
+            groups.setdefault(pool, dict())[pk] = pending[(pool, pk)]
+        await gather(*[self._load_from(pool, futs) for pool, futs in groups.items()])
+
+    async def _load_from(self, pool, futs):
+        pks = list(futs)
+        try:
+            rs = await self.model._select_any(self.model._compile_in(len(pks)), _pad_args(pks), pool=pool)
+        except BaseException as e:
+            for fut in futs.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        # 用str比较主键，URL里传进来的主键都是字符串
+        rows = {str(r[self.model.__primary_key__]): r for r in rs}
+        for pk, fut in futs.items():
+            if not fut.done():
+                fut.set_result(rows.get(str(pk)))
+
+
+# in (...)的参数个数补齐到2的幂，这样不同批次大小只会编译出少数几种语句
+def _in_size(n):
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+
+def _pad_args(args):
+    return args + [args[-1]] * (_in_size(len(args)) - len(args))
+
+
+# 只查了部分列的对象，访问没查出来的列时抛这个异常。
+# 故意不继承AttributeError：jinja2把AttributeError当成未定义、渲染成空白，getattr(obj, key, None)也会把它吞掉
+class DeferredColumnError(Exception):
+    pass
+
+
+# 关联的数据没有prefetch就访问时抛这个异常，和DeferredColumnError一样不继承AttributeError，
+# 否则模板里忘了prefetch只会悄悄渲染成空白
+class RelationNotLoadedError(Exception):
+    pass
+
+
+# 紧凑行对象：只读查询(比如后台导出上万行)不需要完整的Model，用元组存一行的值，对象本身只有两个slot，
+# 比dict省内存，也不用为每一行构造dict。每个Model按查询的列生成一个Row子类，列名是按位置取值的property。
+# 仍然可以像dict一样用row['name']、row.keys()、row.items()，模板可以直接用，to_dict()用于JSON序列化。
+# 像comment.html_content这样不是列的属性存在_extra里。注意列名不能和Mapping的方法(keys、items、get、values)重名。
+class Row(collections.abc.Mapping):
+    __slots__ = ('_values', '_extra')
+    __model__ = None
+    __columns__ = ()
+    __positions__ = {}
+
+    def __init__(self, values):
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_extra', None)
+
+    def __getattr__(self, key):
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        if key in self.__model__.__mappings__:
+            raise DeferredColumnError(r"column '%s' of %s was not loaded" % (key, self.__model__.__name__))
+        if key in self.__model__.__relations__:
+            raise self.__model__.__relations__[key].not_loaded(self.__model__)
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    def __setattr__(self, key, value):
+        if key in self.__positions__:
+            object.__setattr__(self, key, value)
+        else:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', dict())
+            self._extra[key] = value
+
+    # 按Mapping的约定，没有的键(包括没查出来的列)抛KeyError，这样in、get()照常工作
+    def __getitem__(self, key):
+        if key in self.__positions__ or (self._extra is not None and key in self._extra):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield from self.__columns__
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return len(self.__columns__) + (len(self._extra) if self._extra is not None else 0)
+
+    def to_dict(self):
+        d = dict(zip(self.__columns__, self._values))
+        if self._extra is not None:
+            d.update(self._extra)
+        return d
+
+    # 需要save/update/remove时转换成完整的Model对象
+    def to_model(self):
+        return self.__model__._hydrate([dict(zip(self.__columns__, self._values))], self.__columns__)[0]
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_dict())
+
+
+def _column_property(i):
+    def fget(self):
+        return self._values[i]
+
+    def fset(self, value):
+        values = list(self._values)
+        values[i] = value
+        object.__setattr__(self, '_values', tuple(values))
+    return property(fget, fset)
+
+
+def make_row_class(model, columns):
+    attrs = dict(__slots__=(), __model__=model, __columns__=columns,
+                 __positions__={c: i for i, c in enumerate(columns)})
+    for i, c in enumerate(columns):
+        attrs[c] = _column_property(i)
+    return type('%sRow' % model.__name__, (Row,), attrs)
 # 定义不同类型的衍生Field，表的不同列的字段的类型不一样
 
 
+# index=True给这一列建普通索引，unique=True建唯一索引；多列的组合索引写在Model的__indexes__/__unique_indexes__里
 class Field(object):
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
+        self.unique = unique
 
     # 此处代码的作用是打印Field类的实例时，返回的内容，或者说呈现将要打印的结果
     def __str__(self):
@@ -80,28 +1049,188 @@ class Field(object):
 
 
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 
 class BooleanField(Field):
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 
 class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index, unique)
 
 
 class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
+
+
+# 关联关系，在Model里声明：
+#   class Comment(Model):
+#       blog = BelongsTo('Blog', 'blog_id', columns=('id', 'name'))
+#   class Blog(Model):
+#       comments = HasMany('Comment', 'blog_id', orderBy='created_at desc')
+#       comment_count = CountOf('Comment', 'blog_id')
+# 关联的数据不会在访问时自动查询(那样列表页就是N+1次查询)，要用findAll(..., prefetch=['blog'])
+# 或Model.prefetch(objs, ['blog'])，每个关联只多一条IN或GROUP BY查询，结果挂到每个对象上
+class Relation(object):
+    def __init__(self, target, key):
+        self.target = target  # 关联的Model的类名，声明时那个类可能还没定义
+        self.key = key
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        try:
+            return dict.__getitem__(obj, self.name)
+        except KeyError:
+            raise self.not_loaded(owner)
+
+    def not_loaded(self, owner):
+        return RelationNotLoadedError(r"relation '%s' of %s was not loaded, use prefetch" % (self.name, owner.__name__))
+
+    def model(self):
+        return get_model(self.target)
+
+    async def load(self, owner, objs, cache=False):
+        raise NotImplementedError
+
+
+# 去重后的关联键，和查出来的行用str比较，免得数据库返回的类型和对象里的不一样
+def _relation_keys(objs, attr):
+    keys = dict()
+    for obj in objs:
+        k = getattr(obj, attr)
+        if k is not None:
+            keys.setdefault(str(k), k)
+    return list(keys.values())
+
+
+def _in_where(column, n):
+    return '`%s` in (%s)' % (column, ', '.join(['?'] * _in_size(n)))
+
+
+# 挂到Model对象上不算改动，不会被update写回数据库；紧凑行对象挂在_extra里
+def _attach(obj, name, value):
+    if isinstance(obj, Row):
+        setattr(obj, name, value)
+    else:
+        dict.__setitem__(obj, name, value)
+
+
+# 多对一：comment.blog是blog_id对应的Blog对象，找不到是None
+class BelongsTo(Relation):
+    def __init__(self, target, key, columns=None):
+        super().__init__(target, key)
+        self.columns = columns
+
+    async def load(self, owner, objs, cache=False):
+        model = self.model()
+        keys = _relation_keys(objs, self.key)
+        found = dict()
+        if keys:
+            pk = model.__primary_key__
+            rows = await model.findAll(_in_where(pk, len(keys)), _pad_args(keys), columns=self.columns, cache=cache)
+            found = dict((str(getattr(r, pk)), r) for r in rows)
+        for obj in objs:
+            k = getattr(obj, self.key)
+            _attach(obj, self.name, found.get(str(k)) if k is not None else None)
+
+
+# 一对多：blog.comments是blog_id等于这篇日志主键的Comment列表
+class HasMany(Relation):
+    def __init__(self, target, key, orderBy=None, columns=None):
+        super().__init__(target, key)
+        self.orderBy = orderBy
+        self.columns = columns
+
+    async def load(self, owner, objs, cache=False):
+        model = self.model()
+        keys = _relation_keys(objs, owner.__primary_key__)
+        groups = dict()
+        if keys:
+            rows = await model.findAll(_in_where(self.key, len(keys)), _pad_args(keys), orderBy=self.orderBy,
+                                       columns=self.columns, cache=cache)
+            for r in rows:
+                groups.setdefault(str(getattr(r, self.key)), []).append(r)
+        for obj in objs:
+            _attach(obj, self.name, groups.get(str(getattr(obj, owner.__primary_key__)), []))
+
+
+# 一对多的计数：blog.comment_count是这篇日志的评论数，用一条group by查询
+class CountOf(Relation):
+    async def load(self, owner, objs, cache=False):
+        model = self.model()
+        keys = _relation_keys(objs, owner.__primary_key__)
+        counts = dict()
+        if keys:
+            size = _in_size(len(keys))
+            sql = model.__sql_cache__.get(('count_of', self.key, size))
+            if sql is None:
+                sql = model._cache_sql(('count_of', self.key, size), to_driver_sql(
+                    'select `%s` _key_, count(*) _num_ from `%s` where %s group by `%s`' % (
+                        self.key, model.__table__, _in_where(self.key, len(keys)), self.key)))
+            for r in await model._select_any(sql, _pad_args(keys), cache=cache):  # 分片时每个键只在一个分片上，拼起来就行
+                counts[str(r['_key_'])] = r['_num_']
+        for obj in objs:
+            _attach(obj, self.name, counts.get(str(getattr(obj, owner.__primary_key__)), 0))
+
+
+__models = dict()  # 类名 -> Model子类，元类创建每个Model时登记
+__check_indexes = False  # 为True时，每种新的查询形状第一次编译时检查有没有能用上的索引，没有就打警告
+
+
+def _register_model(model):
+    __models[model.__name__] = model
+
+
+def get_models():
+    return list(__models.values())
+
+
+def get_model(name):
+    return __models[name]
+
+
+def check_indexes(enabled=True):
+    global __check_indexes
+    __check_indexes = enabled
+
+
+def _checking_indexes():
+    return __check_indexes
+
+
+_RE_WHERE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<|>|\bin\b|\blike\b|\bis\b)', re.IGNORECASE)
+
+
+# 粗略地判断一个查询能不能用上索引：where里出现的列至少要有一个是某个索引的第一列；
+# 没有where只有order by时，order by的第一列要是某个索引的第一列。返回None表示可以，否则返回说明
+def missing_index(model, where=None, orderBy=None):
+    leading = set(columns[0] for name, columns, unique in model.__index_list__)
+    if where:
+        cols = set(c for c in _RE_WHERE_COLUMN.findall(where) if c in model.__mappings__)
+        if cols and not cols & leading:
+            return 'no index on %s for where %s' % (model.__table__, where)
+    elif orderBy:
+        col = orderBy.split(',')[0].split()[0].strip('`')
+        if col in model.__mappings__ and col not in leading:
+            return 'no index on %s for order by %s' % (model.__table__, orderBy)
+    return None
+
+
 # 定义Model的元类
 # 所有的元类都继承自type，ModelMetaclass元类定义了所有Model基类（继承ModelMetaclass）的子类实现的操作
 
@@ -145,26 +1274,83 @@ class ModelMetaclass(type):
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句, 这里__select__,__update__,__delete__都是格式化的字符串。
+        # 这些语句已经是驱动需要的%s占位符形式，执行时不再做任何字符串处理
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        attrs['__find__'] = '%s where `%s`=%%s' % (attrs['__select__'], primaryKey)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
-        attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__update__'] = 'update `%s` set %s where `%s`=%%s' % (tableName, ', '.join(map(lambda f: '`%s`=%%s' % (mappings.get(f).name or f), fields)), primaryKey)
+        attrs['__delete__'] = 'delete from `%s` where `%s`=%%s' % (tableName, primaryKey)
+        attrs['__sql_cache__'] = dict()  # 编译好的语句缓存，key是(where, orderBy, limit形状)
+        attrs['__columns__'] = tuple(mappings)  # 全部列，按定义的顺序，紧凑行对象按这个顺序存值
+        attrs['__row_classes__'] = dict()  # 列的元组 -> 紧凑行类
+        # 子类写了__cache__ = dict(maxsize=..., ttl=...)就给按主键查询(find)加一层进程内缓存
+        cache = attrs.get('__cache__', None)
+        attrs['__pk_cache__'] = LRUCache(**cache) if cache else None
+        # 所有索引：[(索引名, 列的元组, 是否唯一)]，主键索引叫PRIMARY
+        indexes = [('PRIMARY', (primaryKey,), True)]
+        for k, v in mappings.items():
+            if not v.primary_key and (v.index or v.unique):
+                indexes.append(('%s_%s_%s' % ('uniq' if v.unique else 'idx', tableName, k), (k,), v.unique))
+        for unique, declared in ((False, attrs.get('__indexes__', ())), (True, attrs.get('__unique_indexes__', ()))):
+            for columns in declared:
+                for c in columns:
+                    if c not in mappings:
+                        raise Exception('Index column not found: %s' % c)
+                indexes.append(('%s_%s_%s' % ('uniq' if unique else 'idx', tableName, '_'.join(columns)), tuple(columns), unique))
+        attrs['__index_list__'] = indexes
+        attrs['__relations__'] = dict((k, v) for k, v in attrs.items() if isinstance(v, Relation))
+        model = type.__new__(cls, name, bases, attrs)
+        _register_model(model)
+        return model
 
 
 class Model(dict, metaclass=ModelMetaclass):
+    __pk_cache__ = None
+    __pk_loader__ = None
+    __batch_window__ = 0  # find(pk)合批的等待时间(秒)，0表示攒一轮事件循环，None表示不合批
+    __relations__ = dict()  # 属性名 -> Relation，由元类收集
+    __write_behind__ = None  # 见start_write_behind
+    __shard_key__ = None  # 分片键，比如'blog_id'；db配置的shards里有这张表时，按它把行分到各个分片
+    __single_flight__ = False  # 为True时这个Model的查询默认合并同时发出的相同查询，见select
+    __compact__ = False  # findAll/iter_all默认是否返回紧凑行对象(Row)
+    __counters__ = None  # 维护行数计数器的分组字段，()表示只计整张表，None表示不维护，见count
+
+    # _dirty记录自从加载(或上次save/update)以来改过的字段，update只写这些字段；
+    # 新构造的对象所有传进来的字段都算改过，从数据库加载的对象用_from_row构造，一开始是干净的
     def __init__(self, **kw):
+        object.__setattr__(self, '_dirty', set(kw))
         super(Model, self).__init__(**kw)
 
+    @classmethod
+    def _from_row(cls, row):
+        obj = cls(**row)
+        obj._dirty.clear()
+        return obj
+
+    # findAll/find用columns只查了部分列时，_deferred记录没有加载的列：
+    # 访问没加载的列直接抛DeferredColumnError，要用的话先await obj.load(...)补查，这是唯一的延迟加载方式
+    # (getValue/getValueOrDefault也一样，部分加载的对象不能save)
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            deferred = self.__dict__.get('_deferred')
+            if deferred is not None and key in deferred:
+                raise DeferredColumnError(r"column '%s' of %s was not loaded, use await obj.load('%s')" % (
+                    key, self.__class__.__name__, key))
+            if key in self.__relations__:
+                raise self.__relations__[key].not_loaded(self.__class__)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    # 赋的值和原来一样就不算改动，比如编辑日志时只改了summary，content原样提交回来也不会被写回去
+    def __setitem__(self, key, value):
+        if key not in self or dict.__getitem__(self, key) != value:
+            self._dirty.add(key)
+        dict.__setitem__(self, key, value)
+
     def getValue(self, key):
         return getattr(self, key, None)
 
@@ -178,70 +1364,883 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    # 把columns整理成按__mappings__顺序排列、一定包含主键的元组，None表示查全部列
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        sql = [cls.__select__]  # 类的__select__属性是一个长字符串代表这sql语句，放到列表里当作一个元素，再构造sql变量
+    def _columns(cls, columns):
+        if columns is None:
+            return None
+        for c in columns:
+            if c not in cls.__mappings__:
+                raise ValueError('Invalid column for %s: %s' % (cls.__name__, c))
+        return tuple(k for k in cls.__mappings__ if k == cls.__primary_key__ or k in columns)
+
+    @classmethod
+    def _select_clause(cls, columns):
+        if columns is None:
+            return cls.__select__
+        return 'select %s from `%s`' % (', '.join('`%s`' % c for c in columns), cls.__table__)
+
+    @classmethod
+    def _row_class(cls, columns):
+        row_cls = cls.__row_classes__.get(columns)
+        if row_cls is None:
+            row_cls = cls.__row_classes__[columns] = make_row_class(cls, columns)
+        return row_cls
+
+    # 紧凑模式下rs是按columns顺序排列的元组行，直接包成Row；否则rs是dict行，构造Model对象
+    @classmethod
+    def _hydrate(cls, rs, columns=None, compact=False):
+        if compact:
+            row_cls = cls._row_class(columns or cls.__columns__)
+            return [row_cls(r) for r in rs]
+        if columns is None or len(columns) == len(cls.__mappings__):
+            return [cls._from_row(r) for r in rs]
+        missing = frozenset(cls.__mappings__).difference(columns)
+        objs = []
+        for r in rs:
+            obj = cls._from_row(r)
+            object.__setattr__(obj, '_deferred', missing)
+            objs.append(obj)
+        return objs
+
+    # 按主键把没加载的列从数据库里补上，不传columns就补齐全部没加载的列
+    async def load(self, *columns):
+        deferred = self.__dict__.get('_deferred')
+        if deferred is None:
+            return self
+        columns = self._columns(columns or deferred)
+        shard = None
+        if self._shards() and self.__shard_key__ in self:
+            shard = self.getValue(self.__shard_key__)
+        rs = await self._select_any(self._compile('`%s`=?' % self.__primary_key__, None, None, columns),
+                                    [self.getValue(self.__primary_key__)], 1, shard=shard)
+        if rs:
+            for k in columns:
+                if k in deferred:
+                    dict.__setitem__(self, k, rs[0][k])
+        missing = deferred.difference(columns)
+        object.__setattr__(self, '_deferred', missing or None)
+        return self
+
+    @classmethod
+    def _check_index(cls, where=None, orderBy=None):
+        if _checking_indexes():
+            problem = missing_index(cls, where, orderBy)
+            if problem:
+                logging.warning('%s: %s' % (cls.__name__, problem))
+
+    @classmethod
+    def _cache_sql(cls, key, sql):
+        if len(cls.__sql_cache__) < _SQL_CACHE_SIZE:
+            cls.__sql_cache__[key] = sql
+        return sql
+
+    # 同样形状的查询只拼一次SQL，之后直接从__sql_cache__里取驱动可以直接执行的语句
+    # total=True时在结果的最后加一列count(*) over()，每一行都带上不考虑limit时的总行数
+    @classmethod
+    def _compile(cls, where=None, orderBy=None, limit=None, columns=None, total=False):
+        key = ('select', where, orderBy, _limit_shape(limit), columns, total)
+        sql = cls.__sql_cache__.get(key)
+        if sql is not None:
+            return sql
+        cls._check_index(where, orderBy)
+        sql = [cls._select_clause(columns)]  # 类的__select__属性是一个长字符串代表这sql语句，放到列表里当作一个元素，再构造sql变量
+        if total:
+            sql[0] = sql[0].replace(' from ', ', count(*) over() `_total_` from ', 1)
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []  # args变成空列表
-        orderBy = kw.get('orderBy', None)  # kw.get('orderBy') 得到关键字参数orderBy对应的值，又赋值给了orderBy变量
         if orderBy:
             sql.append('order by')
-            sql.append(orderBy)  # 此时sql变量将有三个元素了
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)  # limit值赋予args
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)  # 调用select函数查询，传入参数sql字符串，args
-        return [cls(**r) for r in rs]
+            sql.append(orderBy)
+        if key[3] == 1:
+            sql.append('limit ?')
+        elif key[3] == 2:
+            sql.append('limit ?, ?')
+        return cls._cache_sql(key, to_driver_sql(' '.join(sql)))
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    def _compile_number(cls, selectField, where=None):
+        key = ('number', selectField, where)
+        sql = cls.__sql_cache__.get(key)
+        if sql is not None:
+            return sql
+        cls._check_index(where)
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)  # 调用select函数查询,传入参数sql字符串，args默认，size=1。前面是在准备sql语句
-        logging.info(rs)  # 返回一个[{'_num_': 3}]字典列表
+        return cls._cache_sql(key, to_driver_sql(' '.join(sql)))
+
+    @classmethod
+    def _compile_seek(cls, where, key, direction, columns=None):
+        cacheKey = ('seek', where, key, direction, columns)
+        sql = cls.__sql_cache__.get(cacheKey)
+        if sql is not None:
+            return sql
+        cls._check_index(where, key)
+        # 默认按(key, 主键)倒序；before是往回翻，先正序取再在内存里倒过来
+        op, order = ('>', 'asc') if direction == 'before' else ('<', 'desc')
+        conds = []
+        if where:
+            conds.append('(%s)' % where)
+        if direction:
+            conds.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (key, op, key, cls.__primary_key__, op))
+        sql = [cls._select_clause(columns)]
+        if conds:
+            sql.append('where')
+            sql.append(' and '.join(conds))
+        sql.append('order by `%s` %s, `%s` %s limit ?' % (key, order, cls.__primary_key__, order))
+        return cls._cache_sql(cacheKey, to_driver_sql(' '.join(sql)))
+
+    # 键集分页(seek method)：after/before是上一页边界行的(key值, 主键值)，
+    # 数据库只需沿着索引从游标位置往后读limit+1行，翻到第几页代价都一样，不像limit offset那样要扫描并丢弃前面所有行
+    # 返回(rows, has_more)，has_more表示沿翻页方向还有没有更多的行
+    @classmethod
+    async def findSeek(cls, where=None, args=None, after=None, before=None, limit=10, key='created_at',
+                       columns=None, compact=False, prefetch=None, shard=None):
+        columns = cls._columns(columns)
+        pools = cls._pools_for(where, args, shard)
+        if pools is not None and len(pools) > 1 and columns is not None and key not in columns:
+            columns = cls._columns(columns + (key,))  # 跨分片时要按key归并
+        if compact:
+            columns = columns or cls.__columns__
+        if after is not None and before is not None:
+            raise ValueError('Only one of after and before can be given.')
+        cursor, direction = (after, 'after') if after is not None else (before, 'before' if before is not None else None)
+        args = list(args) if args else []
+        if cursor is not None:
+            value, pk = cursor
+            args.extend([value, value, pk])
+        args.append(limit + 1)
+        sql = cls._compile_seek(where, key, direction, columns)
+        if pools is None or len(pools) == 1:
+            rs = await select(sql, args, as_tuple=compact, pool=pools[0] if pools else None)
+        else:
+            # 每个分片都取limit+1行，归并后前limit+1行就是全局的结果
+            parts = await gather(*[select(sql, args, as_tuple=compact, pool=pool) for pool in pools])
+            desc = direction != 'before'
+            rs = _sort_rows([r for part in parts for r in part], [(key, desc), (cls.__primary_key__, desc)],
+                            columns if compact else None)[:limit + 1]
+        rows = cls._hydrate(rs[:limit], columns, compact)
+        if direction == 'before':
+            rows.reverse()
+        return await cls.prefetch(rows, prefetch), len(rs) > limit
+
+    @classmethod
+    def _compile_in(cls, n):
+        size = _in_size(n)
+        key = ('in', size)
+        sql = cls.__sql_cache__.get(key)
+        if sql is not None:
+            return sql
+        return cls._cache_sql(key, '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(size)))
+
+    # columns=['id', 'name', ...]只查这些列(主键总会查)，返回的对象只加载了部分列，
+    # 访问没加载的列抛DeferredColumnError，需要时用await obj.load(...)补查
+    # compact=True返回紧凑行对象(Row)，适合只读的大列表
+    # cache=True先查结果缓存(query_cache)，这张表被Model写过以后缓存自动作废
+    # single_flight=True合并同时发出的相同查询，不写时用Model的__single_flight__
+    # prefetch=['blog', ...]顺带查出这些关联，见Relation
+    # 分片的Model：where里有"分片键=?"或者传了shard=分片键的值时只查一个分片，否则查所有分片再在内存里排序、截取
+    @classmethod
+    async def findAll(cls, where=None, args=None, **kw):
+        orderBy = kw.get('orderBy', None)  # kw.get('orderBy') 得到关键字参数orderBy对应的值，又赋值给了orderBy变量
+        limit = kw.get('limit', None)
+        columns = cls._columns(kw.get('columns', None))
+        compact = kw.get('compact', cls.__compact__)
+        if compact:
+            columns = columns or cls.__columns__
+        pools = cls._pools_for(where, args, kw.get('shard', None))
+        if pools is not None and len(pools) > 1:
+            return await cls._scatter_all(pools, where, args, **kw)
+        sql = cls._compile(where, orderBy, limit, columns)
+        args = list(args) if args else []  # 复制一份，不修改调用方传进来的列表
+        if isinstance(limit, int):
+            args.append(limit)
+        elif limit is not None:
+            args.extend(limit)  # limit值赋予args
+        rs = await cls._select(sql, args, as_tuple=compact, cache=kw.get('cache', False),
+                               single_flight=kw.get('single_flight', None),
+                               pool=pools[0] if pools else None)  # 调用select函数查询
+        return await cls.prefetch(cls._hydrate(rs, columns, compact),
+                                  kw.get('prefetch', None), kw.get('cache', False))
+
+    # 一次查出objs的关联数据(见Relation)，每个关联一条查询，几个关联之间并发执行
+    @classmethod
+    async def prefetch(cls, objs, names, cache=False):
+        if not names or not objs:
+            return objs
+        relations = []
+        for name in names:
+            if name not in cls.__relations__:
+                raise ValueError('Invalid relation of %s: %s' % (cls.__name__, name))
+            relations.append(cls.__relations__[name])
+        await gather(*[r.load(cls, objs, cache) for r in relations])
+        return objs
+
+    # cache=True时先查结果缓存；事务里可能读到还没提交的数据，不读也不写缓存
+    # 缓存里的行每次复制一份返回，调用方(比如_find_page_window删掉_total_)不会改到缓存
+    @classmethod
+    async def _select(cls, sql, args, size=None, as_tuple=False, cache=False, single_flight=None, pool=None):
+        if single_flight is None:
+            single_flight = cls.__single_flight__
+        if not cache or _transaction.get() is not None:
+            return await select(sql, args, size, as_tuple, single_flight, pool)
+        # 版本号在查询之前取，查询期间有写入的话这条结果不会被命中；不同分片上同样的查询结果不同，分开缓存
+        key = query_cache.key(cls.__table__, sql, args, size, as_tuple, id(pool) if pool else None)
+        rs = query_cache.get(key)
+        if rs is None:
+            rs = await select(sql, args, size, as_tuple, single_flight, pool)
+            query_cache.put(key, rs)
+        return list(rs) if as_tuple else [dict(r) for r in rs]
+
+    # 这张表的分片连接池，没有分片返回None
+    @classmethod
+    def _shards(cls):
+        return shard_pools(cls.__table__) if cls.__shard_key__ else None
+
+    @classmethod
+    def _shard_for(cls, value):
+        shards = cls._shards()
+        if not shards:
+            return None
+        if value is None:
+            raise ShardingError('%s.%s is required to pick a shard' % (cls.__name__, cls.__shard_key__))
+        return shards[_shard_index(value, len(shards))]
+
+    # 这个对象所在的分片，没有分片返回None(用默认的连接池)
+    def _shard_of(self):
+        if not self._shards():
+            return None
+        return self._shard_for(self.getValue(self.__shard_key__))
+
+    # 查询要发到哪些分片：指定了shard或者where里有"分片键=?"就只查一个分片，否则查所有分片；没有分片返回None
+    @classmethod
+    def _pools_for(cls, where=None, args=None, shard=None):
+        shards = cls._shards()
+        if not shards:
+            return None
+        if shard is None:
+            shard = _shard_value(cls.__shard_key__, where, args)
+        if shard is None:
+            return shards
+        return [shards[_shard_index(shard, len(shards))]]
+
+    # 条件里没有分片键的查询(比如按主键)：有分片时每个分片查一遍，结果拼起来
+    @classmethod
+    # 没有分片时pool指定连接池，默认按读写分离的规则选
+    async def _select_any(cls, sql, args, size=None, as_tuple=False, cache=False, single_flight=None, shard=None,
+                          pool=None):
+        pools = cls._pools_for(shard=shard)
+        if pools is None or len(pools) == 1:
+            return await cls._select(sql, args, size, as_tuple, cache, single_flight, pools[0] if pools else pool)
+        parts = await gather(*[cls._select(sql, args, size, as_tuple, cache, single_flight, pool) for pool in pools])
+        rs = [r for part in parts for r in part]
+        return rs[:size] if size else rs
+
+    # 跨分片的findAll：每个分片取排在前面的offset+count行，在内存里按orderBy归并后再截取
+    @classmethod
+    async def _scatter_all(cls, pools, where, args, **kw):
+        order = _order_columns(kw.get('orderBy', None))
+        limit = kw.get('limit', None)
+        columns = cls._columns(kw.get('columns', None))
+        if columns is not None and any(c not in columns for c, desc in order):
+            columns = cls._columns(columns + tuple(c for c, desc in order))  # 排序用的列必须查出来
+        compact = kw.get('compact', cls.__compact__)
+        if compact:
+            columns = columns or cls.__columns__
+        offset, count = (0, limit) if isinstance(limit, int) else (limit or (0, None))
+        args = list(args) if args else []
+        if count is not None:
+            args.append(offset + count)
+        sql = cls._compile(where, kw.get('orderBy', None), None if count is None else offset + count, columns)
+        parts = await gather(*[cls._select(sql, args, as_tuple=compact, cache=kw.get('cache', False),
+                                           single_flight=kw.get('single_flight', None), pool=pool) for pool in pools])
+        rs = _sort_rows([r for part in parts for r in part], order, columns if compact else None)
+        if count is not None:
+            rs = rs[offset:offset + count]
+        return await cls.prefetch(cls._hydrate(rs, columns, compact),
+                                  kw.get('prefetch', None), kw.get('cache', False))
+
+    # 分页查询，返回(Page, rows)，代替先findNumber再findAll两次串行的查询：
+    # 没有where且Model维护了计数器时，总条数直接用计数器；否则用count(*) over()在一条语句里同时查出这一页和总条数，
+    # 数据库不支持窗口函数(MySQL 8.0以前)时，改成用gather并发执行count和分页两条查询
+    @classmethod
+    async def findPage(cls, page_index=1, where=None, args=None, page_size=10, **kw):
+        offset = page_size * (page_index - 1)
+        if where is None and cls.__counters__ is not None:
+            total, rows = await gather(cls.count(), cls.findAll(limit=(offset, page_size), **kw))
+            page = Page(total, page_index, page_size)
+            return page, rows if page.limit else []
+        error = None
+        pools = cls._pools_for(where, args, kw.get('shard', None))
+        if _window_functions() and (pools is None or len(pools) == 1):  # 跨分片时每个分片的总数要分别count再相加
+            try:
+                return await cls._find_page_window(page_index, page_size, offset, where, args,
+                                                   pool=pools[0] if pools else None, **kw)
+            except _get_driver().syntax_errors as e:
+                error = e
+        total, rows = await gather(cls.findNumber('count(*)', where, args, kw.get('cache', False), kw.get('shard', None)),
+                                 cls.findAll(where, args, limit=(offset, page_size), **kw))
+        if error is not None:
+            # 分开查询成功了，说明刚才失败是因为不支持窗口函数，而不是where写错了
+            _window_functions(False)
+            logging.warning('window functions not supported, fall back to separate count: %s' % error)
+        page = Page(total, page_index, page_size)
+        return page, rows if page.limit else []
+
+    @classmethod
+    async def _find_page_window(cls, page_index, page_size, offset, where, args, pool=None, **kw):
+        columns = cls._columns(kw.get('columns', None))
+        compact = kw.get('compact', cls.__compact__)
+        if compact:
+            columns = columns or cls.__columns__
+        sql = cls._compile(where, kw.get('orderBy', None), (offset, page_size), columns, total=True)
+        rs = await cls._select(sql, (list(args) if args else []) + [offset, page_size], as_tuple=compact,
+                               cache=kw.get('cache', False), pool=pool)
+        if rs:
+            if compact:
+                total = rs[0][-1]
+                rs = [r[:-1] for r in rs]
+            else:
+                total = rs[0]['_total_']
+                for r in rs:
+                    del r['_total_']
+        elif offset:
+            # 页码超出范围时拿不到总条数，只能再查一次
+            total = await cls.findNumber('count(*)', where, args, kw.get('cache', False), kw.get('shard', None))
+        else:
+            total = 0
+        page = Page(total, page_index, page_size)
+        if not page.limit:
+            return page, []
+        return page, await cls.prefetch(cls._hydrate(rs, columns, compact),
+                                        kw.get('prefetch', None), kw.get('cache', False))
+
+    # 用法：async for c in Comment.iter_all(orderBy='created_at', chunk_size=500): ...
+    # 中途break的话，最好用contextlib.aclosing包一下，保证连接立刻释放而不是等生成器被回收
+    # 分片的Model跨分片时一个分片一个分片地读，没法保证全局顺序，所以不能带orderBy
+    @classmethod
+    async def iter_all(cls, where=None, args=None, orderBy=None, chunk_size=1000, columns=None, compact=None):
+        columns = cls._columns(columns)
+        compact = cls.__compact__ if compact is None else compact
+        if compact:
+            columns = columns or cls.__columns__
+        pools = cls._pools_for(where, args)
+        if pools is not None and len(pools) > 1 and orderBy:
+            raise ShardingError('iter_all with orderBy cannot span shards of %s' % cls.__table__)
+        sql = cls._compile(where, orderBy, None, columns)
+        for pool in pools or (None,):
+            rows = select_stream(sql, args, chunk_size, as_tuple=compact, pool=pool)
+            try:
+                async for r in rows:
+                    yield cls._hydrate((r,), columns, compact)[0]
+            finally:
+                await rows.aclose()  # 外层生成器被关闭时要把内层的也关掉，否则连接要等垃圾回收才释放
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None, cache=False, shard=None):
+        pools = cls._pools_for(where, args, shard)
+        if pools is not None and len(pools) > 1:
+            return await cls._scatter_number(pools, selectField, where, args, cache)
+        rs = await cls._select(cls._compile_number(selectField, where), args, 1, cache=cache,
+                               pool=pools[0] if pools else None)  # size=1，只取一行
         if len(rs) == 0:
             return None
         return rs[0]['_num_']  # 把_num_值返回
 
+    # 跨分片的findNumber：只支持能把各分片的结果合起来的count/sum/max/min
     @classmethod
-    async def find(cls, pk):
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+    async def _scatter_number(cls, pools, selectField, where, args, cache):
+        fn = selectField.split('(', 1)[0].strip().lower()
+        if fn not in _MERGE_NUMBER or 'distinct' in selectField.lower():
+            raise ShardingError('Cannot merge %s across shards of %s' % (selectField, cls.__table__))
+        sql = cls._compile_number(selectField, where)
+        parts = await gather(*[cls._select(sql, args, 1, cache=cache, pool=pool) for pool in pools])
+        values = [rs[0]['_num_'] for rs in parts if rs and rs[0]['_num_'] is not None]
+        if not values:
+            return 0 if fn == 'count' else None
+        return _MERGE_NUMBER[fn](values)
+
+    # 缓存里存的是数据库原始行，每次都构造新对象返回，调用方修改对象(比如把passwd改成******)不会污染缓存
+    # 缓存里的是完整的行，能满足任何columns；只查部分列时不走合批，也不写缓存
+    # 分片的Model按主键查要查所有分片，知道分片键的值时传shard=值只查一个分片
+    @classmethod
+    async def find(cls, pk, columns=None, single_flight=None, shard=None):
+        if single_flight is None:
+            single_flight = cls.__single_flight__
+        cache = cls.__pk_cache__
+        if cache is not None:
+            row = cache.get(pk)
+            if row is not None:
+                return cls._from_row(row)
+        columns = cls._columns(columns)
+        if columns is not None:
+            rs = await cls._select_any(cls._compile('`%s`=?' % cls.__primary_key__, None, None, columns), [pk], 1,
+                                       single_flight=single_flight, shard=shard)
+            return cls._hydrate(rs, columns)[0] if rs else None
+        if cls.__batch_window__ is not None and _transaction.get() is None and shard is None:
+            if cls.__pk_loader__ is None or cls.__pk_loader__.model is not cls:
+                cls.__pk_loader__ = PkLoader(cls, cls.__batch_window__)
+            row = await cls.__pk_loader__.load(pk)
+        else:
+            rs = await cls._select_any(cls.__find__, [pk], 1, single_flight=single_flight, shard=shard)
+            row = rs[0] if rs else None
+        if row is None:
             return None
-        return cls(**rs[0])
+        if cache is not None:
+            cache.put(pk, row)
+        return cls._from_row(row)
 
-    async def save(self):
+    @classmethod
+    def cache_stats(cls):
+        return cls.__pk_cache__.stats() if cls.__pk_cache__ is not None else None
+
+    # 事务里写的数据可能回滚，所以不写入缓存，只让缓存失效，并在事务结束后再失效一次
+    def _cache_refresh(self):
+        if self.__pk_cache__ is not None:
+            if _transaction.get() is not None:
+                self._cache_invalidate()
+            else:
+                self.__pk_cache__.put(self.getValue(self.__primary_key__), {k: self.getValue(k) for k in self.__mappings__})
+
+    # 表里的数据变了，这张表的查询结果缓存全部作废；事务里的写在提交前别人看不到，提交后再作废一次
+    @classmethod
+    def _results_invalidate(cls):
+        query_cache.bump(cls.__table__)
+        if _transaction.get() is not None:
+            _after_transaction(lambda: query_cache.bump(cls.__table__))
+
+    def _cache_invalidate(self):
+        if self.__pk_cache__ is not None:
+            pk = self.getValue(self.__primary_key__)
+            self.__pk_cache__.pop(pk)
+            if _transaction.get() is not None:
+                _after_transaction(lambda: self.__pk_cache__.pop(pk))
+
+    # 多行INSERT的语句按每批行数缓存，满批和最后一批各编译一次
+    @classmethod
+    def _compile_insert_many(cls, n):
+        key = ('insert_many', n)
+        sql = cls.__sql_cache__.get(key)
+        if sql is not None:
+            return sql
+        head, values = cls.__insert__.split(' values ')
+        return cls._cache_sql(key, '%s values %s' % (head, ', '.join([values] * n)))
+
+    def _insert_args(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        return args
+
+    @classmethod
+    def _insert_statements(cls, objs, batch_size):
+        statements = []
+        batch = []
+        for obj in objs:
+            batch.extend(obj._insert_args())
+            if len(batch) == batch_size * (len(cls.__fields__) + 1):
+                statements.append((cls._compile_insert_many(batch_size), batch))
+                batch = []
+        if batch:
+            statements.append((cls._compile_insert_many(len(batch) // (len(cls.__fields__) + 1)), batch))
+        return statements
+
+    # 批量插入：每batch_size个对象拼成一条多行INSERT，所有批次在同一个连接的同一个事务里执行，返回每批插入的行数
+    # 分片的Model每个分片各用一个事务，只保证同一个分片上的行要么都插入要么都不插入
+    @classmethod
+    async def save_many(cls, objs, batch_size=500):
+        if batch_size < 1:
+            raise ValueError('Invalid batch_size value: %s' % batch_size)
+        objs = list(objs)
+        if not objs:
+            return []
+        groups = dict()  # 分片的连接池 -> 这个分片上的对象，没有分片时只有一组None
+        for obj in objs:
+            groups.setdefault(obj._shard_of(), []).append(obj)
+        parts = await gather(*[execute_batches(cls._insert_statements(group, batch_size), pool)
+                               for pool, group in groups.items()])
+        counts = [n for part in parts for n in part]
+        for obj in objs:
+            obj._dirty.clear()
+            obj._cache_refresh()
+        cls._results_invalidate()
+        logging.info('inserted %s rows into %s in %s batches' % (sum(counts), cls.__table__, len(counts)))
+        await _adjust_counters(cls, objs, 1)
+        return counts
+
+    async def save(self):
+        rows = await execute(self.__insert__, self._insert_args(), pool=self._shard_of())
         if rows != 1:
             logging.warning('failed to insert record: affected rows: %s' % rows)
+        else:
+            self._dirty.clear()
+            self._cache_refresh()
+            self._results_invalidate()
+            await _adjust_counters(self.__class__, [self], 1)
+
+    # 开启了写后缓冲(start_write_behind)时，写进日志和队列就返回，稍后批量写入数据库；
+    # 没开启或者在事务里就是save()，事务回滚时这一行也要跟着回滚
+    async def save_later(self):
+        if self.__write_behind__ is None or _transaction.get() is not None:
+            return await self.save()
+        await self.__write_behind__.put(self)
+        self._dirty.clear()
 
+    @classmethod
+    def _compile_update(cls, fields):
+        key = ('update', fields)
+        sql = cls.__sql_cache__.get(key)
+        if sql is not None:
+            return sql
+        return cls._cache_sql(key, 'update `%s` set %s where `%s`=%%s' % (
+            cls.__table__, ', '.join(map(lambda f: '`%s`=%%s' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__))
+
+    # 只更新改过的字段，不同的字段组合各编译一次UPDATE语句；没有改动就不访问数据库
+    # 只加载了部分列的对象，没加载的列不会被改动，也就不会被写回去
+    # 分片键决定了行在哪个分片上，不能改
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        fields = tuple(f for f in self.__fields__ if f in self._dirty)
+        if not fields:
+            return
+        if self.__shard_key__ in fields and self._shards():
+            raise ShardingError('Cannot update shard key %s of %s' % (self.__shard_key__, self.__class__.__name__))
+        sql = self.__update__ if len(fields) == len(self.__fields__) else self._compile_update(fields)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args, pool=self._shard_of())
+        self._cache_invalidate()
+        self._results_invalidate()
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
+        else:
+            self._dirty.clear()
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await execute(self.__delete__, args, pool=self._shard_of())
+        self._cache_invalidate()
+        self._results_invalidate()
         if rows != 1:
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
+        else:
+            await _adjust_counters(self.__class__, [self], -1)
+
+    # 行数计数器：__counters__ = ('blog_id',)表示维护整张表的行数，以及按blog_id分组的行数。
+    # 计数保存在内存和counters表里，save/remove时增减，reconcile_counters定期用真实的count校正。
+    # 条件不是计数器能覆盖的(比如有where、或者按别的字段分组)，就退回到count(*)
+    @classmethod
+    async def count(cls, **predicate):
+        if cls.__counters__ is None or len(predicate) > 1 or not set(predicate).issubset(cls.__counters__):
+            where = ' and '.join('`%s`=?' % k for k in predicate) or None
+            return await cls.findNumber('count(*)', where, list(predicate.values()))
+        name = counter_name(cls, **predicate)
+        value = _counter_get(name)
+        if value is not None:
+            return value
+        rs = await select(Counter.__find__, [name], 1)
+        if rs:
+            value = rs[0]['value']
+        else:
+            where = ' and '.join('`%s`=?' % k for k in predicate) or None
+            value = await cls.findNumber('count(*)', where, list(predicate.values()))
+            await execute(_counter_upsert(), [name, value])
+        _counter_put(name, value)
+        return value
+
+
+# counters表，name是计数器的名字，比如'comments'或者'comments:blog_id=xxx'
+class Counter(Model):
+    __table__ = 'counters'
+
+    name = StringField(primary_key=True, ddl='varchar(100)')
+    value = IntegerField()
+
+
+_COUNTER_ADD = 'update `counters` set `value`=`value`+%s where `name`=%s'
+_COUNTER_TTL = 30  # 内存里的计数多久以后重新从counters表读，其他进程的增减靠这个同步过来
+__counter_values = dict()  # 计数器名字 -> (值, 读取的时间)
+
+
+def _counter_upsert():
+    return __driver.upsert('counters', ('name', 'value'), 'name')
+
+
+def counter_name(model, **predicate):
+    if not predicate:
+        return model.__table__
+    k, v = next(iter(predicate.items()))
+    return '%s:%s=%s' % (model.__table__, k, v)
+
+
+def _counter_get(name):
+    item = __counter_values.get(name)
+    if item is None or time.monotonic() - item[1] > _COUNTER_TTL:
+        return None
+    return item[0]
+
+
+def _counter_put(name, value):
+    __counter_values[name] = (value, time.monotonic())
+
+
+def _counter_pop(names):
+    for name in names:
+        __counter_values.pop(name, None)
+
+
+# 插入或删除objs之后调整计数：counters表里只更新已经存在的计数器，还没建立的计数器第一次count时会用真实的count初始化。
+# 在事务里时counters表的更新和数据的写入一起提交或回滚，内存里的计数在事务结束后作废，下次从表里重新读
+async def _adjust_counters(model, objs, sign):
+    if model.__counters__ is None:
+        return
+    deltas = collections.Counter()
+    for obj in objs:
+        deltas[counter_name(model)] += sign
+        for k in model.__counters__:
+            v = obj.getValue(k)
+            if v is not None:
+                deltas[counter_name(model, **{k: v})] += sign
+    await execute_batches([(_COUNTER_ADD, [d, name]) for name, d in deltas.items()])
+    if _transaction.get() is not None:
+        _after_transaction(lambda: _counter_pop(deltas))
+        return
+    for name, d in deltas.items():
+        item = __counter_values.get(name)
+        if item is not None:
+            __counter_values[name] = (item[0] + d, item[1])
+
+
+# 用真实的count校正计数器。按分组的计数器只校正counters表里已经有的(也就是被count用到过的)
+async def reconcile_counters(models):
+    for model in models:
+        if model.__counters__ is None:
+            continue
+        name = counter_name(model)
+        total = await model.findNumber('count(*)')
+        await execute(_counter_upsert(), [name, total])
+        _counter_put(name, total)
+        for k in model.__counters__:
+            prefix = '%s:%s=' % (model.__table__, k)
+            rs = await select(Counter._compile('`name` like ?', None, None, ('name',)), [prefix + '%'])
+            names = [r['name'] for r in rs]
+            for i in range(0, len(names), 500):
+                batch = names[i:i + 500]
+                values = [n[len(prefix):] for n in batch]
+                counts = dict((str(r[k]), r['_num_']) for r in await model._select_any(
+                    'select `%s`, count(*) _num_ from `%s` where `%s` in (%s) group by `%s`' % (
+                        k, model.__table__, k, create_args_string(len(values)), k), values))
+                statements = []
+                for n, v in zip(batch, values):
+                    statements.append((_counter_upsert(), [n, counts.get(v, 0)]))
+                    _counter_put(n, counts.get(v, 0))
+                await execute_batches(statements)
+        logging.info('reconciled counters of %s' % model.__table__)
+
+
+# 在后台每interval秒校正一次计数器
+def start_counter_reconciler(models, interval=300):
+    async def run():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await reconcile_counters(models)
+            except Exception as e:
+                logging.exception(e)
+    return asyncio.ensure_future(run())
+
+
+# 写后缓冲：只追加的表(比如评论)在高峰时不必每个请求都等一次INSERT。
+# obj.save_later()先把这一行追加到本地日志文件并fsync，再放进内存队列就返回；
+# 后台任务每interval秒或攒够batch_size行用一条多行INSERT写入数据库。
+# 日志里的行用insert ignore写入，进程崩溃后启动时重放日志，已经写进去的行按主键忽略，不会重复。
+# 队列满了(maxsize行)时save_later等待，直到刷出空间或者请求的截止时间到了。
+# 还没刷到数据库的行，查询是看不到的，最多晚interval秒。
+class WriteBehind(object):
+    def __init__(self, model, journal, interval=0.05, batch_size=500, maxsize=10000, fsync=True):
+        self.model = model
+        self.journal = journal
+        self.interval = interval
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self.fsync = fsync
+        self.flushed = 0
+        self.errors = 0
+        self._queue = collections.deque()  # 已经写进日志、等着写入数据库的对象
+        self._lines = []  # 等着写进日志的(行, future)
+        self._syncing = False
+        self._flushing = 0  # 正在写入数据库的行数
+        self._lock = asyncio.Lock()  # 日志文件的追加和清空互斥
+        self._space = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._file = None
+
+    @property
+    def pending(self):
+        return len(self._queue) + len(self._lines) + self._flushing
+
+    async def put(self, obj):
+        if len(self._queue) + len(self._lines) >= self.maxsize:
+            timeout = _remaining()
+            try:
+                await asyncio.wait_for(self._wait_space(), timeout)
+            except asyncio.TimeoutError:
+                raise QueryTimeoutError('write-behind queue of %s is full' % self.model.__table__)
+        row = dict((k, obj.getValueOrDefault(k)) for k in self.model.__mappings__)
+        fut = asyncio.get_event_loop().create_future()
+        self._lines.append((json.dumps(row, ensure_ascii=False), fut, obj))
+        if not self._syncing:
+            self._syncing = True
+            asyncio.ensure_future(self._sync())
+        await asyncio.shield(fut)  # 调用方被取消时这一行仍然会写进日志和队列
+
+    async def _wait_space(self):
+        async with self._space:
+            while len(self._queue) + len(self._lines) >= self.maxsize:
+                await self._space.wait()
+
+    # 组提交：同一时刻到来的多行一起写日志、一次fsync
+    async def _sync(self):
+        while self._lines:
+            lines, self._lines = self._lines, []
+            try:
+                async with self._lock:
+                    await _run_blocking(self._append, '\n'.join(line for line, fut, obj in lines) + '\n')
+                    for line, fut, obj in lines:
+                        self._queue.append(obj)
+            except Exception as e:
+                for line, fut, obj in lines:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for line, fut, obj in lines:
+                if not fut.done():
+                    fut.set_result(None)
+            if len(self._queue) >= self.batch_size:
+                self._wakeup.set()
+        self._syncing = False
+
+    def _append(self, data):
+        if self._file is None:
+            self._file = open(self.journal, 'a', encoding='utf-8')
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    # 数据库里已经有了日志里的全部行，清空日志
+    def _truncate(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        open(self.journal, 'w').close()
+
+    def _read(self):
+        if not os.path.exists(self.journal):
+            return []
+        objs = []
+        with open(self.journal, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    objs.append(self.model._from_row(json.loads(line)))
+                except ValueError:
+                    logging.warning('skip broken line in %s: %r' % (self.journal, line))  # 崩溃时写了一半的行
+        return objs
+
+    async def start(self):
+        objs = await _run_blocking(self._read)
+        if objs:
+            logging.info('replay %s rows of %s from %s' % (len(objs), self.model.__table__, self.journal))
+            for i in range(0, len(objs), self.batch_size):
+                await self._insert(objs[i:i + self.batch_size], replay=True)
+        async with self._lock:
+            await _run_blocking(self._truncate)
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.errors += 1
+                logging.warning('write-behind flush of %s failed, will retry: %s' % (self.model.__table__, e))
+
+    async def flush(self):
+        while self._queue:
+            objs = [self._queue.popleft() for n in range(min(self.batch_size, len(self._queue)))]
+            self._flushing += len(objs)
+            try:
+                await self._insert(objs)
+            except BaseException:
+                self._queue.extendleft(reversed(objs))  # 放回队首，下一轮重试
+                raise
+            finally:
+                self._flushing -= len(objs)
+            self.flushed += len(objs)
+            async with self._space:
+                self._space.notify_all()
+        async with self._lock:
+            if not self._queue and not self._flushing and self._file is not None:
+                await _run_blocking(self._truncate)
+
+    async def _insert(self, objs, replay=False):
+        model = self.model
+        groups = dict()  # 分片的Model按分片分组，每个分片一条INSERT
+        for obj in objs:
+            groups.setdefault(obj._shard_of(), []).append(obj)
+        counts = await gather(*[self._insert_ignore(group, pool) for pool, group in groups.items()])
+        model._results_invalidate()
+        if not replay and sum(counts) == len(objs):
+            await _adjust_counters(model, objs, 1)  # 重放时不知道哪些行以前已经写过，计数交给reconcile_counters校正
+
+    async def _insert_ignore(self, objs, pool):
+        model = self.model
+        key = ('insert_ignore_many', len(objs))
+        sql = model.__sql_cache__.get(key)
+        if sql is None:
+            sql = model._cache_sql(key, model._compile_insert_many(len(objs)).replace(
+                'insert', _get_driver().insert_ignore, 1))
+        args = []
+        for obj in objs:
+            args.extend(obj._insert_args())
+        return sum(await execute_batches([(sql, args)], pool))
+
+    async def close(self):
+        if self._task is not None:
+            # 等后台任务真正结束：它正在写的那一批被取消后会放回队列，下面的flush再写
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        while self._syncing:
+            await asyncio.sleep(0)
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.model.__write_behind__ is self:
+            self.model.__write_behind__ = None  # 关闭以后save_later回到直接save()
+
+
+# 文件读写这类阻塞操作放到线程池里，不阻塞事件循环
+async def _run_blocking(fn, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(fn, *args))
+
+
+# 给model开启写后缓冲，之后model的save_later()走这个队列；启动时先重放上次没写完的日志
+async def start_write_behind(model, journal, **kw):
+    model.__write_behind__ = await WriteBehind(model, journal, **kw).start()
+    return model.__write_behind__
 
 
 
@@ -0,0 +1,102 @@
+# 根据Model的定义生成建表、建索引的DDL，并和数据库里实际的表结构做比较
+# 用法：
+#   python -m www.schema ddl     打印所有表的CREATE TABLE语句
+#   python -m www.schema diff    连接数据库，打印缺少的表和索引需要执行的语句，以及数据库里多出来的索引
+# SQLite没有information_schema，用create_all()直接建表建索引(已存在的会跳过)
+import sys
+import asyncio
+import logging
+import www.orm
+from www.orm import get_models, select, execute
+from www.config import configs
+import www.models
+
+
+def _index_sql(model, name, columns, unique, dialect='mysql'):
+    return 'create %sindex %s`%s` on `%s` (%s);' % ('unique ' if unique else '',
+                                                    'if not exists ' if dialect == 'sqlite' else '', name,
+                                                    model.__table__, ', '.join('`%s`' % c for c in columns))
+
+
+# dialect='sqlite'时索引不能写在建表语句里，要另外用create_index_sql建
+def create_table_sql(model, dialect='mysql'):
+    lines = []
+    for k, f in model.__mappings__.items():
+        lines.append('  `%s` %s not null' % (k, f.column_type))
+    for name, columns, unique in model.__index_list__:
+        cols = ', '.join('`%s`' % c for c in columns)
+        if name == 'PRIMARY':
+            lines.append('  primary key (%s)' % cols)
+        elif dialect == 'mysql':
+            lines.append('  %skey `%s` (%s)' % ('unique ' if unique else '', name, cols))
+    if dialect == 'sqlite':
+        return 'create table if not exists `%s` (\n%s\n);' % (model.__table__, ',\n'.join(lines))
+    return 'create table `%s` (\n%s\n) engine=innodb default charset=utf8;' % (model.__table__, ',\n'.join(lines))
+
+
+def create_index_sql(model, dialect='mysql'):
+    return [_index_sql(model, name, columns, unique, dialect)
+            for name, columns, unique in model.__index_list__ if name != 'PRIMARY']
+
+
+# 在SQLite里建好所有表和索引，要先调用create_pool(driver='sqlite')
+async def create_all(models=None):
+    for model in models or get_models():
+        for pool in model._shards() or [None]:  # 分片的表在每个分片上都建一遍
+            await execute(create_table_sql(model, 'sqlite'), [], pool=pool)
+            for sql in create_index_sql(model, 'sqlite'):
+                await execute(sql, [], pool=pool)
+
+
+# 和数据库里的实际结构比较，返回(需要执行的语句, 数据库里有但Model没有声明的索引)
+async def diff_schema(model):
+    rs = await select('select count(*) _num_ from information_schema.tables where table_schema=database() and table_name=%s',
+                      [model.__table__], 1)
+    if not rs or not rs[0]['_num_']:
+        return [create_table_sql(model)], []
+    # MySQL 8.0的information_schema返回大写的列名，都起个小写的别名
+    rs = await select('select index_name as index_name, non_unique as non_unique, column_name as column_name '
+                      'from information_schema.statistics '
+                      'where table_schema=database() and table_name=%s order by index_name, seq_in_index',
+                      [model.__table__])
+    live = dict()
+    for r in rs:
+        columns, unique = live.get(r['index_name'], ((), not r['non_unique']))
+        live[r['index_name']] = (columns + (r['column_name'],), unique)
+    statements = []
+    declared = set()
+    for name, columns, unique in model.__index_list__:
+        declared.add((columns, unique))
+        if (columns, unique) not in live.values():
+            statements.append(_index_sql(model, name, columns, unique))
+    extra = ['%s %s' % (name, columns) for name, (columns, unique) in live.items() if (columns, unique) not in declared]
+    return statements, extra
+
+
+async def diff_all(loop):
+    await www.orm.create_pool(loop=loop, **configs.db)
+    for model in get_models():
+        statements, extra = await diff_schema(model)
+        for sql in statements:
+            print(sql)
+        for index in extra:
+            print('-- %s: index not declared in model: %s' % (model.__table__, index))
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'ddl'
+    dialect = configs.db.driver
+    if command == 'ddl':
+        for model in get_models():
+            print(create_table_sql(model, dialect))
+            if dialect == 'sqlite':
+                print('\n'.join(create_index_sql(model, dialect)))
+            print()
+    elif command == 'diff' and dialect == 'sqlite':
+        print('-- diff is not supported for sqlite, use create_all() instead.')
+    elif command == 'diff':
+        logging.basicConfig(level=logging.WARNING)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(diff_all(loop))
+    else:
+        print('usage: python -m www.schema [ddl|diff]')
@@ -0,0 +1,19 @@
+# 游标分页的编解码测试：python -m unittest www.test_apis
+import unittest
+from www.apis import encode_cursor, decode_cursor
+
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor((1.5, 'abc'))), (1.5, 'abc'))
+        self.assertEqual(decode_cursor(encode_cursor((2, 7))), (2, 7))
+
+    def test_invalid_cursor_raises_value_error(self):
+        for token in ('!!', encode_cursor([1]), encode_cursor(['x', 'abc']), encode_cursor([True, 'abc']),
+                      encode_cursor([1, None]), encode_cursor([1, ['abc']]), encode_cursor([1, False])):
+            with self.assertRaises(ValueError):
+                decode_cursor(token)
+
+
+if __name__ == '__main__':
+    unittest.main()
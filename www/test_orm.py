@@ -0,0 +1,420 @@
+# orm的行为测试，用SQLite驱动，不需要MySQL：python -m unittest www.test_orm www.test_shards
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+import unittest
+from www import orm
+from www.models import Blog, Comment
+import www.schema
+
+# 在SQLite里跑差不多0.25秒的查询，用来测截止时间
+SLOW_SQL = 'with recursive c(x) as (select 1 union all select x+1 from c where x < 500000) select count(*) _num_ from c'
+
+
+def new_comment(blog_id='b', content='c', **kw):
+    return Comment(blog_id=blog_id, user_id='u', user_name='n', user_image='i', content=content, **kw)
+
+
+def new_blog(name='b', **kw):
+    return Blog(user_id='u', user_name='n', user_image='i', name=name, summary='s', content='c', **kw)
+
+
+class OrmTestCase(unittest.IsolatedAsyncioTestCase):
+    def pool_options(self):
+        return {}
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        await orm.create_pool(loop=None, driver='sqlite', path=os.path.join(self.tmp, 'test.db'), **self.pool_options())
+        await www.schema.create_all()
+        vars(orm)['__counter_values'].clear()  # 计数器的内存缓存是进程级的，别让上一个测试的值留下来
+
+    async def count(self, where=None, args=None):
+        return await Comment.findNumber('count(*)', where, args)
+
+
+class TransactionTest(OrmTestCase):
+    async def test_commit(self):
+        async with orm.transaction():
+            await new_comment().save()
+            await new_comment().save()
+        self.assertEqual(await self.count(), 2)
+
+    async def test_rollback_on_error(self):
+        with self.assertRaises(ValueError):
+            async with orm.transaction():
+                await new_comment().save()
+                raise ValueError()
+        self.assertEqual(await self.count(), 0)
+
+    async def test_savepoint_rolls_back_inner_only(self):
+        async with orm.transaction():
+            await new_comment(content='outer').save()
+            with self.assertRaises(ValueError):
+                async with orm.transaction():
+                    await new_comment(content='inner').save()
+                    raise ValueError()
+            await new_comment(content='after').save()
+        rows = await Comment.findAll(orderBy='content')
+        self.assertEqual([c.content for c in rows], ['after', 'outer'])
+
+    async def test_statement_inside_stream_raises(self):
+        await Comment.save_many([new_comment() for i in range(3)])
+        with self.assertRaises(orm.StreamOpenError):
+            async with orm.transaction():
+                async for c in Comment.iter_all():
+                    c.content = 'x'
+                    await c.update()
+        self.assertEqual(await self.count("content='x'"), 0)
+        async with orm.transaction():
+            for c in [c async for c in Comment.iter_all()]:
+                c.content = 'x'
+                await c.update()
+        self.assertEqual(await self.count("content='x'"), 3)
+
+    async def test_concurrent_read_then_write(self):
+        async def run():
+            async with orm.transaction():
+                await Comment.findAll('blog_id=?', ['b'])
+                await new_comment().save()
+        await asyncio.gather(*[run() for i in range(30)])
+        self.assertEqual(await self.count(), 30)
+
+
+class DeadlineTest(OrmTestCase):
+    async def test_slow_query_is_cancelled(self):
+        with self.assertRaises(orm.QueryTimeoutError):
+            with orm.deadline(0.05):
+                await orm.select(SLOW_SQL, [])
+        self.assertEqual(await self.count(), 0)  # 被终止的连接已经丢弃，连接池还能用
+
+    async def test_expired_deadline(self):
+        with orm.deadline(1):
+            with orm.deadline(0.01):
+                await asyncio.sleep(0.02)
+                with self.assertRaises(orm.QueryTimeoutError):
+                    await Comment.findAll()
+            await Comment.findAll()  # 外层的截止时间还没到
+
+
+class PoolTimeoutTest(OrmTestCase):
+    def pool_options(self):
+        return dict(maxsize=1, checkout_timeout=0.05)
+
+    async def test_saturated_pool_raises(self):
+        async def count_within(seconds):
+            with orm.deadline(seconds):
+                return await self.count()
+        async with orm.transaction():  # 占住唯一的连接，事务外的查询借不到连接
+            await new_comment().save()
+            with self.assertRaises(orm.PoolTimeoutError):
+                await orm._detached(self.count())
+            with self.assertRaises(orm.QueryTimeoutError):  # 截止时间比checkout_timeout近时按截止时间算
+                await orm._detached(count_within(0.01))
+        self.assertEqual(orm.pool_metrics()[0]['timeouts'], 2)
+        self.assertEqual(await self.count(), 1)
+
+
+class SingleFlightTest(OrmTestCase):
+    async def test_identical_queries_share_one_execution(self):
+        await new_comment().save()
+        before = orm.single_flight_stats()['joined']
+        results = await asyncio.gather(*[Comment.findAll('blog_id=?', ['b'], single_flight=True) for i in range(5)])
+        self.assertEqual(orm.single_flight_stats()['joined'] - before, 4)
+        self.assertEqual([len(rs) for rs in results], [1] * 5)
+        results[0][0].content = 'changed'  # 每个调用方拿到各自的拷贝
+        self.assertEqual(results[1][0].content, 'c')
+
+    async def test_caller_deadline_does_not_leak_into_shared_query(self):
+        async def short():
+            with orm.deadline(0.05):
+                return await orm.select(SLOW_SQL, [], single_flight=True)
+
+        async def unbounded():
+            await asyncio.sleep(0)  # 让short先发起查询
+            return await orm.select(SLOW_SQL, [], single_flight=True)
+        a, b = await asyncio.gather(short(), unbounded(), return_exceptions=True)
+        self.assertIsInstance(a, orm.QueryTimeoutError)
+        self.assertEqual(b[0]['_num_'], 500000)
+
+
+class PkLoaderTest(OrmTestCase):
+    async def test_finds_are_batched(self):
+        cs = [new_comment(content=str(i)) for i in range(5)]
+        await Comment.save_many(cs)
+        orm.query_stats.reset()
+        found = await asyncio.gather(*[Comment.find(c.id) for c in cs], Comment.find('missing'))
+        self.assertEqual([c.content if c else None for c in found], ['0', '1', '2', '3', '4', None])
+        self.assertEqual(orm.query_stats.get(Comment._compile_in(6))['count'], 1)  # 6个find合成了一条查询
+
+    async def test_caller_deadline_does_not_leak_into_batch(self):
+        c = new_comment()
+        await c.save()
+
+        async def short():
+            with orm.deadline(1e-5):
+                return await Comment.find(c.id)
+        a, b = await asyncio.gather(short(), Comment.find(c.id), return_exceptions=True)
+        self.assertIsInstance(a, orm.QueryTimeoutError)
+        self.assertEqual(b.id, c.id)
+
+
+class ReadYourWritesTest(OrmTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # 复制延迟很大的从库：建了表、但一行数据都没有；SQLite驱动不支持从库，直接塞给orm
+        self.replica = await orm._get_driver().create_pool(None, dict(path=os.path.join(self.tmp, 'replica.db')))
+        self.addAsyncCleanup(self.replica.wait_closed)
+        self.addCleanup(self.replica.close)
+        vars(orm)['__pool_metrics'][self.replica] = orm.PoolMetrics('replica-0', self.replica)
+        vars(orm)['__replicas'] = [self.replica]
+        await orm.execute(www.schema.create_table_sql(Blog, 'sqlite'), [], pool=self.replica)
+        vars(orm)['__read_your_writes'] = 5
+
+    async def test_batched_find_reads_primary_after_write(self):
+        orm.set_consistency_key('writer')
+        blog = new_blog()
+        await blog.save()
+        Blog.__pk_cache__.pop(blog.id)
+
+        async def other_session():
+            orm.set_consistency_key('reader')
+            return await Blog.find(blog.id)
+        # 同一轮事件循环里的两个find，一个要读主库，一个读从库，不能合成一批
+        mine, theirs = await asyncio.gather(Blog.find(blog.id), other_session())
+        self.assertEqual(mine.id, blog.id)
+        self.assertIsNone(theirs)
+
+
+class RowTest(OrmTestCase):
+    async def test_compact_row_mapping_and_json(self):
+        c = new_comment(content='hello')
+        await c.save()
+        row = (await Comment.findAll(columns=('content',), compact=True))[0]
+        self.assertIsInstance(row, orm.Row)
+        self.assertEqual((row.id, row['content']), (c.id, 'hello'))
+        self.assertEqual(dict(row), {'id': c.id, 'content': 'hello'})
+        self.assertNotIn('user_name', row)
+        self.assertIsNone(row.get('user_name'))
+        with self.assertRaises(KeyError):
+            row['user_name']
+        with self.assertRaises(orm.DeferredColumnError):
+            row.user_name
+        row.score = 3  # 不是查询的列，放在额外的属性里，一样能序列化
+        self.assertEqual(json.loads(json.dumps(row, default=lambda o: o.to_dict())),
+                         {'id': c.id, 'content': 'hello', 'score': 3})
+
+    async def test_to_model(self):
+        await new_comment(content='hello').save()
+        row = (await Comment.findAll(columns=('content',), compact=True))[0]
+        c = row.to_model()
+        c.content = 'edited'
+        await c.update()
+        self.assertEqual((await Comment.findAll())[0].content, 'edited')
+
+
+class UpdateTest(OrmTestCase):
+    async def test_only_changed_fields_are_written(self):
+        await new_blog().save()
+        blog = (await Blog.findAll())[0]
+        blog.summary = 'changed'
+        blog.content = 'c'  # 和原来一样，不算改动
+        orm.query_stats.reset()
+        await blog.update()
+        self.assertEqual(list(orm.query_stats.snapshot()), [orm.query_stats.shape(Blog._compile_update(('summary',)))])
+        found = (await Blog.findAll())[0]
+        self.assertEqual((found.summary, found.content), ('changed', 'c'))
+
+    async def test_unchanged_object_is_not_written(self):
+        blogs = [new_blog(name=str(i)) for i in range(3)]
+        await Blog.save_many(blogs)
+        orm.query_stats.reset()
+        for blog in blogs:
+            await blog.update()  # save_many以后对象是干净的
+        self.assertEqual(orm.query_stats.snapshot(), {})
+        self.assertEqual((await Blog.find(blogs[1].id)).name, '1')  # save_many也填了主键缓存
+        self.assertEqual(orm.query_stats.snapshot(), {})
+
+
+class PkCacheTest(OrmTestCase):
+    async def test_find_uses_cache_until_write(self):
+        blog = new_blog(name='old')
+        await blog.save()
+        orm.query_stats.reset()
+        found = await Blog.find(blog.id)
+        self.assertEqual(orm.query_stats.snapshot(), {})  # save以后就在缓存里
+        found.name = 'local'  # 改返回的对象不会改到缓存
+        self.assertEqual((await Blog.find(blog.id)).name, 'old')
+        blog.name = 'new'
+        await blog.update()
+        self.assertEqual((await Blog.find(blog.id)).name, 'new')
+        await blog.remove()
+        self.assertIsNone(await Blog.find(blog.id))
+
+    async def test_rolled_back_write_is_not_cached(self):
+        blog = new_blog(name='old')
+        await blog.save()
+        with self.assertRaises(ValueError):
+            async with orm.transaction():
+                blog.name = 'rolled back'
+                await blog.update()
+                raise ValueError()
+        self.assertEqual((await Blog.find(blog.id)).name, 'old')
+
+
+class QueryCacheTest(OrmTestCase):
+    async def cached(self):
+        return [c.content for c in await Comment.findAll('blog_id=?', ['b'], orderBy='content', cache=True)]
+
+    async def test_writes_invalidate_cached_results(self):
+        c = new_comment(content='a')
+        await c.save()
+        self.assertEqual(await self.cached(), ['a'])
+        orm.query_stats.reset()
+        self.assertEqual(await self.cached(), ['a'])
+        self.assertEqual(orm.query_stats.snapshot(), {})  # 命中缓存
+        await new_comment(content='b').save()
+        self.assertEqual(await self.cached(), ['a', 'b'])
+        c.content = 'c'
+        await c.update()
+        self.assertEqual(await self.cached(), ['b', 'c'])
+        await c.remove()
+        self.assertEqual(await self.cached(), ['b'])
+        await Comment.save_many([new_comment(content='d')])
+        self.assertEqual(await self.cached(), ['b', 'd'])
+
+    async def test_transaction_invalidates_after_commit(self):
+        self.assertEqual(await self.cached(), [])
+        async with orm.transaction():
+            await new_comment(content='a').save()
+            self.assertEqual(await self.cached(), ['a'])  # 事务里不读缓存
+            self.assertEqual(await orm._detached(self.cached()), [])  # 事务外的读者看不到，结果进了缓存
+        self.assertEqual(await self.cached(), ['a'])
+
+
+class CounterTest(OrmTestCase):
+    async def counter_row(self, name):
+        rs = await orm.select(orm.Counter.__find__, [name], 1)
+        return rs[0]['value'] if rs else None
+
+    async def test_save_and_remove_adjust_counters(self):
+        await Comment.save_many([new_comment('b1'), new_comment('b1'), new_comment('b2')])
+        self.assertEqual((await Comment.count(), await Comment.count(blog_id='b1')), (3, 2))
+        c = new_comment('b1')
+        await c.save()
+        orm.query_stats.reset()
+        self.assertEqual((await Comment.count(), await Comment.count(blog_id='b1')), (4, 3))
+        self.assertEqual(orm.query_stats.snapshot(), {})  # 内存里的计数，不查数据库
+        await c.remove()
+        with self.assertRaises(ValueError):
+            async with orm.transaction():
+                await new_comment('b1').save()
+                raise ValueError()
+        vars(orm)['__counter_values'].clear()
+        self.assertEqual((await self.counter_row('comments'), await self.counter_row('comments:blog_id=b1')), (3, 2))
+        self.assertEqual(await Comment.count(blog_id='b1'), 2)
+
+    async def test_reconcile_fixes_drift(self):
+        await Comment.save_many([new_comment('b1'), new_comment('b2')])
+        self.assertEqual((await Comment.count(), await Comment.count(blog_id='b1')), (2, 1))
+        await orm.execute('delete from `comments` where `blog_id`=?', ['b1'])  # 绕过Model，计数器不知道
+        self.assertEqual(await Comment.count(blog_id='b1'), 1)
+        await orm.reconcile_counters([Comment])
+        self.assertEqual((await Comment.count(), await Comment.count(blog_id='b1')), (1, 0))
+        self.assertEqual(await self.counter_row('comments:blog_id=b1'), 0)
+
+
+class PartialLoadTest(OrmTestCase):
+    async def test_unloaded_column_raises_until_loaded(self):
+        await new_comment(content='hello').save()
+        c = (await Comment.findAll(columns=('blog_id',)))[0]
+        self.assertEqual(c.blog_id, 'b')
+        with self.assertRaises(orm.DeferredColumnError):
+            c.content
+        with self.assertRaises(orm.DeferredColumnError):
+            getattr(c, 'content', None)
+        await c.load('content')
+        self.assertEqual(c.content, 'hello')
+        with self.assertRaises(orm.DeferredColumnError):
+            c.user_name
+        await c.load()
+        self.assertEqual(c.user_name, 'n')
+
+
+class PrefetchTest(OrmTestCase):
+    async def test_prefetch_relations(self):
+        blogs = [new_blog(name='B%d' % i) for i in range(3)]
+        await Blog.save_many(blogs)
+        await Comment.save_many([new_comment(blogs[i].id, content=str(i)) for i in range(3) for j in range(i)])
+        orm.query_stats.reset()
+        rows = await Blog.findAll(orderBy='name', prefetch=['comments', 'comment_count'])
+        self.assertEqual([(len(b.comments), b.comment_count) for b in rows], [(0, 0), (1, 1), (2, 2)])
+        self.assertEqual(sum(st['count'] for st in orm.query_stats.snapshot().values()), 3)  # 每种关联一条查询
+        rows = await Comment.findAll(orderBy='content', prefetch=['blog'])
+        self.assertEqual([c.blog.name for c in rows], ['B1', 'B2', 'B2'])
+        self.assertEqual(set(rows[0].blog), {'id', 'name'})  # 只查了声明的columns
+
+    async def test_not_prefetched_raises(self):
+        await new_blog().save()
+        blog = (await Blog.findAll())[0]
+        with self.assertRaises(orm.RelationNotLoadedError):
+            blog.comments
+        with self.assertRaises(orm.RelationNotLoadedError):
+            getattr(blog, 'comment_count', None)  # 不是AttributeError，不会被默认值吞掉
+
+
+class WriteBehindTest(OrmTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.journal = os.path.join(self.tmp, 'comments.journal')
+
+    async def crash(self, wb):
+        wb._task.cancel()
+        while wb._syncing:
+            await asyncio.sleep(0)
+        if wb._file is not None:
+            wb._file.close()
+
+    async def test_flush(self):
+        wb = await orm.start_write_behind(Comment, self.journal, interval=0.01)
+        await asyncio.gather(*[new_comment().save_later() for i in range(20)])
+        await wb.close()
+        self.assertEqual(await self.count(), 20)
+        self.assertEqual(os.path.getsize(self.journal), 0)
+        self.assertIsNone(Comment.__write_behind__)
+
+    async def test_transaction_saves_directly(self):
+        wb = await orm.start_write_behind(Comment, self.journal, interval=60)
+        self.addAsyncCleanup(wb.close)
+        with self.assertRaises(ValueError):
+            async with orm.transaction():
+                await new_comment().save_later()
+                raise ValueError()
+        async with orm.transaction():
+            await new_comment().save_later()
+        self.assertEqual(await self.count(), 1)  # 没有经过队列：回滚的那一行不会再被写进去
+        self.assertEqual(len(wb._queue), 0)
+
+    async def test_replay_after_crash(self):
+        wb = await orm.WriteBehind(Comment, self.journal, interval=60).start()
+        for i in range(7):
+            await wb.put(new_comment(content=str(i)))
+        await self.crash(wb)
+        self.assertEqual(await self.count(), 0)
+        with open(self.journal) as f:
+            journal = f.read()
+        wb = await orm.start_write_behind(Comment, self.journal, interval=60)
+        self.assertEqual(await self.count(), 7)
+        await self.crash(wb)
+        with open(self.journal, 'w') as f:  # 重放到一半崩溃，日志里的行又重放一次也不会重复插入
+            f.write(journal + '{"broken')
+        wb = await orm.start_write_behind(Comment, self.journal, interval=60)
+        await wb.close()
+        self.assertEqual(await self.count(), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
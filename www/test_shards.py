@@ -0,0 +1,120 @@
+# 分片的行为测试：comments按blog_id分到3个SQLite库
+import os
+import sqlite3
+import unittest
+from www import orm
+from www.models import Blog, Comment
+from www.test_orm import OrmTestCase, new_comment
+
+SHARDS = 3
+
+
+class ShardTestCase(OrmTestCase):
+    def pool_options(self):
+        return dict(shards=dict(comments=[dict(path=os.path.join(self.tmp, 'shard%d.db' % i)) for i in range(SHARDS)]))
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # 6篇日志，每篇5条评论，created_at = 日志序号*10 + 评论序号
+        self.comments = [new_comment('blog%d' % b, 'c%d-%d' % (b, i), created_at=float(b * 10 + i))
+                         for b in range(6) for i in range(5)]
+        await Comment.save_many(self.comments, batch_size=4)
+
+    def shard_rows(self, where='1=1', args=()):
+        counts = []
+        for pool in orm.shard_pools('comments'):
+            with sqlite3.connect(pool._path) as db:
+                counts.append(db.execute('select count(*) from comments where ' + where, args).fetchone()[0])
+        return counts
+
+    def created(self, rows):
+        return [c.created_at for c in rows]
+
+
+class ShardRoutingTest(ShardTestCase):
+    async def test_rows_are_spread_by_shard_key(self):
+        counts = self.shard_rows()
+        self.assertEqual(sum(counts), 30)
+        for b in range(6):
+            self.assertEqual(sorted(self.shard_rows('blog_id=?', ['blog%d' % b])), [0] * (SHARDS - 1) + [5])
+
+    async def test_query_with_shard_key_hits_one_shard(self):
+        orm.query_stats.reset()
+        rows = await Comment.findAll('blog_id=?', ['blog2'], orderBy='created_at desc')
+        self.assertEqual(self.created(rows), [24.0, 23.0, 22.0, 21.0, 20.0])
+        self.assertEqual(sum(st['count'] for st in orm.query_stats.snapshot().values()), 1)
+
+    async def test_find_update_remove(self):
+        c = await Comment.find(self.comments[7].id)
+        self.assertEqual(c.content, 'c1-2')
+        c.content = 'edited'
+        await c.update()
+        self.assertEqual((await Comment.find(c.id)).content, 'edited')
+        c.blog_id = 'blog0'
+        with self.assertRaises(orm.ShardingError):
+            await c.update()
+        c = await Comment.find(c.id)
+        await c.remove()
+        self.assertEqual(await Comment.findNumber('count(*)'), 29)
+
+    async def test_transaction_cannot_use_shards(self):
+        with self.assertRaises(orm.ShardingError):
+            async with orm.transaction():
+                await new_comment('blog1').save()
+        self.assertEqual(sum(self.shard_rows("content='c'")), 0)
+
+    async def test_prefetch_across_shards(self):
+        await Blog.save_many([Blog(id='blog%d' % b, user_id='u', user_name='n', user_image='i', name='B%d' % b,
+                                   summary='s', content='c') for b in range(6)])
+        blogs = await Blog.findAll(orderBy='id', prefetch=['comments', 'comment_count'])
+        self.assertEqual([(len(b.comments), b.comment_count) for b in blogs], [(5, 5)] * 6)
+        rows = await Comment.findAll(orderBy='created_at', limit=2, prefetch=['blog'])
+        self.assertEqual([c.blog.name for c in rows], ['B0', 'B0'])
+
+
+class ShardMergeTest(ShardTestCase):
+    async def test_order_and_limit_are_merged(self):
+        rows = await Comment.findAll(orderBy='created_at desc', limit=(3, 4))
+        self.assertEqual(self.created(rows), [51.0, 50.0, 44.0, 43.0])
+        rows = await Comment.findAll(orderBy='blog_id desc, created_at', limit=3, compact=True, columns=('content',))
+        self.assertEqual([r.content for r in rows], ['c5-0', 'c5-1', 'c5-2'])
+
+    async def test_unmergeable_order_raises(self):
+        with self.assertRaises(orm.ShardingError):
+            await Comment.findAll(orderBy='length(content)')
+
+    async def test_numbers_are_merged(self):
+        self.assertEqual(await Comment.findNumber('count(*)'), 30)
+        self.assertEqual(await Comment.findNumber('max(created_at)'), 54.0)
+        self.assertEqual(await Comment.findNumber('min(created_at)'), 0.0)
+        self.assertEqual(await Comment.findNumber('count(*)', 'blog_id=?', ['blog1']), 5)
+        with self.assertRaises(orm.ShardingError):
+            await Comment.findNumber('avg(created_at)')
+
+    async def test_find_page(self):
+        page, rows = await Comment.findPage(2, orderBy='created_at desc', page_size=7)
+        self.assertEqual(page.item_count, 30)
+        self.assertEqual(self.created(rows), [42.0, 41.0, 40.0, 34.0, 33.0, 32.0, 31.0])
+        page, rows = await Comment.findPage(2, "content like ?", ['c%'], orderBy='created_at', page_size=7)
+        self.assertEqual(page.item_count, 30)
+        self.assertEqual(self.created(rows), [12.0, 13.0, 14.0, 20.0, 21.0, 22.0, 23.0])
+        page, rows = await Comment.findPage(1, 'blog_id=?', ['blog3'], orderBy='created_at desc', page_size=2)
+        self.assertEqual((page.item_count, self.created(rows)), (5, [34.0, 33.0]))
+
+    async def test_find_seek(self):
+        rows, more = await Comment.findSeek(limit=4)
+        self.assertEqual((self.created(rows), more), ([54.0, 53.0, 52.0, 51.0], True))
+        after, more = await Comment.findSeek(after=(rows[-1].created_at, rows[-1].id), limit=4)
+        self.assertEqual((self.created(after), more), ([50.0, 44.0, 43.0, 42.0], True))
+        before, more = await Comment.findSeek(before=(after[0].created_at, after[0].id), limit=4)
+        self.assertEqual((self.created(before), more), ([54.0, 53.0, 52.0, 51.0], False))
+
+    async def test_iter_all(self):
+        self.assertEqual(len([c async for c in Comment.iter_all()]), 30)
+        with self.assertRaises(orm.ShardingError):
+            async for c in Comment.iter_all(orderBy='created_at'):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()